@@ -5,17 +5,19 @@ Mantra - compile-a-test page
 
 import os
 import json
-import time
 import threading
+import time
 import logging
 import dash_html_components as html
 import dash_core_components as dcc
 import dash.dependencies as dd
+from flask import jsonify, request, Response
 
 # App imports
 from app import app
 from config import cfg
 import qparse
+import jobs
 import utils
 
 
@@ -31,6 +33,72 @@ TIMER = '{}-timer'.format(DISPLAY)
 log = logging.getLogger(cfg.app_name)
 log.debug('logging via %s', log.name)
 
+
+# - STATS ROUTE
+@app.server.route('/stats')
+def serve_stats():
+    'compile metrics of this server process, as json'
+    return jsonify({
+        'metrics': qparse.METRICS.summary(),
+        'pandoc': qparse.PANDOC.stats(),
+        'jobs': jobs.SCHEDULER.stats(),
+        'ast_cache': qparse.AST_CACHE.stats(),
+        'md_cache': qparse.MD_CACHE.stats(),
+    })
+
+
+# - LOG STREAM ROUTE
+@app.server.route('/compile/<test_id>/log')
+def serve_log(test_id):
+    'stream the lines of test_id\'s compile log as server-sent events'
+    # an event's id is the log's offset after its lines, so a client that
+    # reconnects (Last-Event-ID) resumes where it left off
+    try:
+        offset = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        offset = 0
+    c = qparse.Compiler(test_id)
+
+    def events():
+        tail = None
+        while True:
+            if tail is None and c.logfile:
+                tail = utils.LogTail(c.logfile, offset)
+            active = c.running  # before reading, so no lines are missed
+            lines = tail.read() if tail else []
+            if lines:
+                yield 'id: {}\n{}\n\n'.format(tail.position, ''.join(
+                    'data: {}\n'.format(line) for line in lines))
+            elif not active:
+                yield 'event: end\ndata: {}\n\n'.format(c.state)
+                return
+            else:
+                time.sleep(0.25)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+# - EVENTS ROUTE
+@app.server.route('/compile/<test_id>/events')
+def serve_events(test_id):
+    'events of test_id\'s compile after ?cursor=n, waits up to ?wait=secs'
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        wait = min(30.0, float(request.args.get('wait', 0)))
+    except ValueError:
+        return jsonify({'error': 'cursor & wait must be numbers'}), 400
+    c = qparse.Compiler(test_id)
+    events, cursor, missed = c.events(cursor, wait)
+    return jsonify({
+        'events': [e._asdict() for e in events],
+        'cursor': cursor,
+        'missed': missed,
+        'progress': c.progress(),
+    })
+
+
 # - Page Layout
 _layout = html.Div([
     dcc.Interval(interval=1000, id=TIMER, n_intervals=0),
@@ -74,7 +142,8 @@ def terminate(n_intervals, nav):
     OFF = '86400000'  # str(24*60*60*1000) update once per day
     ON = '500'       # str(1*1000) update every second
     nav = utils.UrlNav(*json.loads(nav))
-    if qparse.Compiler(nav.test_id).running:
+    # keep going a little after the job's end, to display last log lines
+    if qparse.Compiler(nav.test_id).recent(2):
         log.debug('[%d], %s running, refresh ON', n_intervals, nav.test_id)
         return ON
     log.debug('[%d], %s terminated, refresh OFF', n_intervals, nav.test_id)
@@ -87,7 +156,7 @@ def terminate(n_intervals, nav):
     [dd.State('app-nav', 'children'),
      dd.State(PROGRESS, 'children')])
 def progress(intervals, nav, progress):
-    'display compiler log file periodically'
+    'display compiler progress periodically'
     nav = utils.UrlNav(*json.loads(nav))
     if nav.test_id is None:
         return html.Div('No Compile target: {}?'.format(nav.test_id))
@@ -95,16 +164,31 @@ def progress(intervals, nav, progress):
     if not c.running and intervals == 0:
         log.debug('Starting compiler for %s', nav.test_id)
         c.start(nav, cfg)  # first time around, start compiler
-        time.sleep(1)      # give thread chance to start
-
-    if c.running:
-        log.debug('[%s] %s running', intervals, c.job)
-        try:
-            with open(c.logfile, 'r') as fh:
-                rv = fh.readlines()
-                progress = html.Pre(''.join(rv))
-        except OSError:
-            log.error('%s not found/readable', c.logfile)
-            return html.Div('error reading compiler log file %s' % c.logfile)
+
+    state = c.state
+    if state == 'queued':
+        return html.Div('queued, position {}'.format(c.position))
+    if state == 'failed' and not c.logfile:
+        return html.Div('compile of {} failed'.format(nav.test_id))
+
+    status = c.progress()
+    if state is not None and status is not None:
+        log.debug('[%s] %s %s', intervals, c.job, status)
+        # from the job's events, the logfile is only read after a failure
+        events, _, missed = c.events()
+        msgs = ['{} {}'.format(e.kind, e.msg) for e in events
+                if e.kind in ('warning', 'error')]
+        if missed:
+            msgs.insert(0, '(older messages dropped)')
+        children = [
+            html.Progress(value=str(int(status['pct'])), max='100'),
+            html.Div('{:.0f}% {} ({}, {} warnings, {} errors)'.format(
+                status['pct'], status['stage'], status['state'],
+                status['warnings'], status['errors'])),
+            html.Pre('\n'.join(msgs)),
+        ]
+        if state == 'failed' and c.logfile:
+            children.append(html.Pre('\n'.join(c.log_lines())))
+        progress = html.Div(children)
 
     return html.Div(children=[progress])
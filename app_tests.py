@@ -4,9 +4,6 @@ Mantra - test selection page
 '''
 import os
 import json
-import shutil
-import threading
-import time
 import csv
 from operator import attrgetter
 import logging
@@ -16,7 +13,10 @@ import dash_core_components as dcc
 
 from app import app
 from config import cfg
+import jobs
+import generation
 import utils
+import watcher
 
 # - Module logger
 log = logging.getLogger(cfg.app_name)
@@ -30,6 +30,18 @@ ID = '{}-{{}}'.format(__name__).format
 CONTROLS = utils.get_domid('controls', PATH)
 DISPLAY = utils.get_domid('display', PATH)
 TESTS = []  # Global list of available tests
+SORTS = [
+    {'value': 'name', 'label': 'Sort by name'},
+    {'value': '-name', 'label': 'Sort by name (desc)'},
+    {'value': 'category', 'label': 'Sort by category'},
+    {'value': '-category', 'label': 'Sort by category (desc)'},
+    {'value': 'flag', 'label': 'Sort by status'},
+    {'value': '-numq', 'label': 'Sort by questions (most)'},
+    {'value': '-compiled', 'label': 'Sort by last compile (newest)'},
+    {'value': '-score', 'label': 'Sort by score (best)'},
+    {'value': 'score', 'label': 'Sort by score (worst)'},
+]
+DB_SORTS = ['numq', 'duration', 'compiled', 'score']  # via mantra.db
 
 
 #-- helpers
@@ -100,23 +112,51 @@ def action_menu(test_id, flag):
                     ])
 
 
-def test_table2(categories):
-    'load mantra.idx from disk and return as html.Table'
-    idxs = utils.MantraIdx(cfg.src_dir, cfg.dst_dir)
+def test_page(categories, search, sort, page, size):
+    'return (idxs, rows, page, pages, total) for a page of tests'
+    # - idxs, the page's MtrIdx (or IdxRow) entries
+    # - rows, test_id -> IdxRow with numq, score etc. of the page's tests
+    key, desc = sort.lstrip('-'), sort.startswith('-')
+    db = watcher.db()
+    if key in DB_SORTS:
+        # sort on columns only mantra.db has
+        total = db.count(category=categories, search=search)
+        pages = max(1, -(-total // size))
+        page = min(max(1, page or 1), pages)
+        idxs = db.query(category=categories, search=search, sort=key,
+                        desc=desc, limit=size, offset=(page - 1) * size)
+        rows = idxs
+    else:
+        # only the rows on the page are rendered, see watcher.Snapshot.page
+        idxs, page, pages, total = watcher.snapshot().page(
+            page, size, categories=categories, search=search, sort=key,
+            desc=desc)
+        rows = db.query(test_ids=[idx.test_id for idx in idxs])
+    return idxs, dict((row.test_id, row) for row in rows), page, pages, total
+
+
+def test_table2(categories, search='', sort='name', page=1):
+    'return a page of the index of tests as html.Table'
+    size = cfg.tests_per_page
+    idxs, stats, page, pages, total = test_page(categories, search, sort,
+                                                page, size)
     rows = [
         # Header row
         html.Tr([
             html.Th('Tests'),
             html.Th(),
             html.Th(),
+            html.Th('Questions'),
+            html.Th('Score'),
             html.Th(),
 
         ])
     ]
     for idx in idxs:
-        if len(categories) and idx.category not in categories:
-            continue
-
+        stat = stats.get(idx.test_id, None)
+        numq = '' if stat is None or stat.numq is None else stat.numq
+        score = '' if stat is None or stat.score is None else \
+            '{:.0f}%'.format(stat.score)
         # 'no_op' disables the link -> see mantra.css
         # link inactive if dsts has yet to be created
         linkClassName = 'no_op' if idx.flag == 'C' else ''
@@ -127,10 +167,17 @@ def test_table2(categories):
                            className=linkClassName,
                            )),
             html.Td(idx.category),
+            html.Td(numq),
+            html.Td(score),
             html.Td(action_menu(idx.test_id, idx.flag)),
         ])  # , title=rowTitle)
         rows.append(row)
 
+    first = (page - 1) * size
+    rows.append(html.Tr(html.Td(
+        '{}-{} of {} tests, page {} of {}'.format(
+            first + 1 if total else 0, first + len(idxs), total, page, pages),
+        colSpan=6)))
     return html.Table(rows)
 
 
@@ -177,13 +224,10 @@ def test_table2(categories):
 
 def category_options():
     'setup categories for category filter on test table'
-    try:
-        tests = utils.MantraIdx(cfg.src_dir, cfg.dst_dir).idx.values()
-    except OSError:
-        tests = []
+    # a category includes its subcategories, label shows the test count
     rv = []
-    for cat in sorted(set([test.category for test in tests])):
-        rv.append({'label': cat, 'value': cat})
+    for cat, node in watcher.snapshot().tree.categories():
+        rv.append({'label': '{} ({})'.format(cat, node.count), 'value': cat})
     return rv
 
 
@@ -200,10 +244,36 @@ _layout = html.Div(
                     value=[],
                     multi=True,
                     placeholder='Category ...',
-                    options=category_options()
+                    options=[]  # see layout()
                     ),
                          style={'display': 'block'}),
 
+                html.Div([
+                    dcc.Input(
+                        id=ID('search'),
+                        type='text',
+                        value='',
+                        placeholder='Search ...',
+                        style={'display': 'inline-block', 'width': '40%'},
+                    ),
+                    html.Div(dcc.Dropdown(
+                        id=ID('sort'),
+                        value='name',
+                        clearable=False,
+                        options=SORTS
+                        ),
+                             style={'display': 'inline-block',
+                                    'width': '40%',
+                                    'vertical-align': 'middle'}),
+                    dcc.Input(
+                        id=ID('page'),
+                        type='number',
+                        min=1,
+                        value=1,
+                        style={'display': 'inline-block', 'width': '20%'},
+                    ),
+                ], style={'display': 'block'}),
+
                 html.Div('loading ...', id=DISPLAY)
             ]),
 
@@ -241,6 +311,7 @@ def layout(nav, controls):
     # return static layout with cached controls settings, if any
     log.debug('nav %s', nav)
     log.debug('controls %s', controls)
+    _layout[ID('category')].options = category_options()
     if len(nav.query):
         _layout[ID('modal-1')].style = {'display': 'block'}
         _layout[ID('modal-timer')].interval = 500  # refresh 1/second
@@ -261,21 +332,31 @@ class QueryHandler(metaclass=utils.Cached):
     def __init__(self, job):
         self.job = job
         self.msgs = []
-        self.running = False
 
     def start(self, nav, cfg):
         self.nav = nav
         self.cfg = cfg
-        threading.Thread(target=self._run, name=self.job).start()
+        jobs.SCHEDULER.submit(('query', self.job), self._run, name=self.job,
+                              priority=jobs.INTERACTIVE)
         return self
 
+    @property
+    def running(self):
+        'True if query job is queued or running'
+        job = jobs.SCHEDULER.job(('query', self.job))
+        return job is not None and job.active
+
+    def recent(self, secs):
+        'True if query job is running or finished less than secs ago'
+        job = jobs.SCHEDULER.job(('query', self.job))
+        return job is not None and job.recent(secs)
+
     @classmethod
     def find(cls, *args):
         'find instance for args or return None'
         return cls._Cached__cache.get(args, None)
 
     def _run(self):
-        self.running = True
         log.debug('QueryHandler(%s) - started', self.job)
         for action in self.nav.query.get('action', []):
             meth = getattr(self, 'do_{}'.format(action), None)
@@ -285,18 +366,14 @@ class QueryHandler(metaclass=utils.Cached):
             else:
                 self.msgs.append('-> {}'.format(action))
             meth()
-            time.sleep(2)  # give modal update callback time to fire
 
     def do_delete(self):
         'delete compiled output files'
+        # unlinks the test's output in one go, its files are removed later on
         dst_dir = os.path.join(self.cfg.dst_dir, self.nav.test_id)
-        for fname in utils.glob_files(dst_dir, ['*']):
-            fullname = os.path.join(dst_dir, fname)
-            log.debug('del %s', fullname)
-            os.remove(fullname)
-            self.msgs.append('rm {}'.format(fullname))
-        shutil.rmtree(dst_dir)
-        self.msgs.append('rmtree {}'.format(dst_dir))
+        gen = generation.remove(self.cfg.dst_dir, self.nav.test_id)
+        log.debug('del %s (%s)', dst_dir, gen)
+        self.msgs.append('rm {}'.format(dst_dir))
         return self
 
     def do_clear_history(self):
@@ -308,11 +385,17 @@ class QueryHandler(metaclass=utils.Cached):
 # -- Page controls
 @app.callback(
     dd.Output(CONTROLS, 'children'),
-    [dd.Input(ID('category'), 'value')])
-def controls(category):
+    [dd.Input(ID('category'), 'value'),
+     dd.Input(ID('search'), 'value'),
+     dd.Input(ID('sort'), 'value'),
+     dd.Input(ID('page'), 'value')])
+def controls(category, search, sort, page):
     'store page state in cache and controls for revisits'
     controls = json.dumps([
         (ID('category'), 'value', category),
+        (ID('search'), 'value', search),
+        (ID('sort'), 'value', sort),
+        (ID('page'), 'value', page),
     ])
     log.debug('save controls %s', controls)
     return controls
@@ -324,11 +407,20 @@ def controls(category):
     [dd.Input(CONTROLS, 'children')])
 def display(controls):
     controls = json.loads(controls)
-    categories = []
+    categories, search, sort, page = [], '', 'name', 1
     for id_, attr, val in controls:
         if id_ == ID('category'):
-            categories = val
-    return test_table2(categories)
+            categories = val or []
+        elif id_ == ID('search'):
+            search = val or ''
+        elif id_ == ID('sort'):
+            sort = val or 'name'
+        elif id_ == ID('page'):
+            try:
+                page = int(val)
+            except (TypeError, ValueError):
+                page = 1
+    return test_table2(categories, search, sort, page)
 
 
 @app.callback(
@@ -377,8 +469,10 @@ def toggle_updates(style, nvals, nav):
     OFF = '86400000'  # once/day
     nav = utils.UrlNav(*json.loads(nav))
     qh = QueryHandler.find(nav.test_id)
-    rv = ON if qh and qh.running else OFF
-    msg = 'running -> ON' if qh and qh.running else 'not found -> OFF'
+    # keep going a little after the job's end, to display its last msgs
+    active = qh is not None and qh.recent(2)
+    rv = ON if active else OFF
+    msg = 'running -> ON' if active else 'not found -> OFF'
     log.debug('QueryHandler(%s) - %s', nav.test_id, msg)
     return rv
 
@@ -393,7 +487,7 @@ def update_modal(nvals, nav, kids):
     nav = utils.UrlNav(*json.loads(nav))
     log.debug('[%s] update_modal', nvals)
     qh = QueryHandler.find(nav.test_id)
-    if qh and qh.running:
+    if qh and qh.recent(2):
         log.debug(' - return %s QueryHandler.msgs', len(qh.msgs))
         return html.Pre('\n'.join(qh.msgs))
     log.debug(' - returning %s kids', len(kids))
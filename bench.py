@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# -*- encoding: utf8 -*-
+'''
+Compile benchmark, using synthetic question banks.
+
+Generates quiz sources of several sizes in a scratch root dir and compiles
+each one in a fresh process (cold caches, own peak RSS) through the full
+pipeline, just like bulk.py does.  Each run reports:
+
+- wall: seconds to compile the test (parse, convert, pack, images)
+- pandoc: number of pandoc runs
+- rss_kb: peak RSS of the compiling process (pandoc itself in pandoc_kb)
+- bytes: size of the compiled output (test dir + stored images)
+- metrics: the compile's own metrics (json only, see qparse.Metrics)
+
+With --hash, it times test_id hashing of synthetic src paths instead: the
+original per byte loop versus utils.hash_test_id, cold and memoized.
+
+With --verify, nothing is timed.  Instead the generated sources (and any
+given files) are checked against pandoc itself:
+- questions compiled as usual (native writer, batched, memoized) must equal
+  those of a compile where pandoc converts each fragment on its own
+- each block & list item of a source, written by the native MdWriter, must
+  equal pandoc's output, unless the writer declines (falls back to pandoc)
+- a search of the index must find the same tests, whatever the sort
+
+Generated sources have nested header levels, fancy list styles, attribute
+paras (tags, answer, explanation) and, optionally, images shared between
+questions.
+
+Usage:
+
+python3 bench.py                        # default sizes, table on stdout
+python3 bench.py -s 10 100 -r 3         # 3 compiles per source: cold, warm..
+python3 bench.py --json > base.jsonl    # machine readable, one run per line
+python3 bench.py --hash 100000          # test_id hashing of 100k paths
+python3 bench.py --verify -s 10 100     # check output against pandoc's
+python3 bench.py --verify my/test.md    # .. and that of my/test.md
+'''
+
+import os
+import sys
+import base64
+import json
+import time
+import random
+import struct
+import zlib
+import shutil
+import tempfile
+import argparse
+import resource
+import subprocess
+
+SIZES = [10, 100, 1000, 5000]
+STYLES = ['1.', 'a)', 'A.', 'i.', '#.', 'I)', '(1)']
+WIDE = ['A.']  # pandoc wants 2 spaces after these, or it's no list marker
+MARKERS = {
+    '1': ['1', '2', '3', '4', '5'],
+    'a': ['a', 'b', 'c', 'd', 'e'],
+    'A': ['A', 'B', 'C', 'D', 'E'],
+    'i': ['i', 'ii', 'iii', 'iv', 'v'],
+    'I': ['I', 'II', 'III', 'IV', 'V'],
+    '#': ['#', '#', '#', '#', '#'],
+}
+WORDS = ('alpha beta *gamma* **delta** `eps` [link](http://x.org) $x^2$ '
+         'route packet frame ~~old~~ "quote" it\'s --dash ...').split()
+NUM_IMGS = 8  # images shared by all questions of a test
+NAMES = ['Net_Case.md', 'Up 50%.md']  # odd names for the search check
+SEARCHES = ['', 'q1', 'Q10', 'I.MD', ' q100 ', '_case', '50%', '%', 'e_',
+            'bench', 'docs']
+
+
+def png(seed):
+    'return bytes of a small, valid png, different for each seed'
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data)))
+    size = 16
+    rows = b''.join(b'\x00' + bytes((seed * 37 + x * y) & 0xff
+                                    for x in range(size))
+                    for y in range(size))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def _text(rnd, lo, hi):
+    return ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(lo, hi)))
+
+
+def generate(numq, images=False, seed=1):
+    'return markdown source of a quiz with numq questions'
+    rnd = random.Random(seed)
+    lines = ['---', 'title: Bench {}'.format(numq), 'tags: bench, generated',
+             '---', '', 'Intro with *some* text.', '']
+    for nr in range(numq):
+        if nr % 10 == 0:
+            # a section header with section wide tags, questions nest below
+            lines += ['# Section {}'.format(nr // 10), '',
+                      'tags: section{}'.format(nr // 10), '']
+        lines += ['{} Question {}: {}'.format('#' * rnd.choice([2, 2, 3]), nr,
+                                              _text(rnd, 1, 4)), '']
+        lines += [_text(rnd, 5, 40), '']
+        if images and rnd.random() < 0.3:
+            lines += ['See ![figure](img/fig{}.png) for details.'.format(
+                rnd.randrange(NUM_IMGS)), '']
+        if rnd.random() < 0.2:
+            lines += ['```', 'show ip route {}'.format(nr), '```', '']
+
+        style = rnd.choice(STYLES)
+        for k in range(rnd.randint(2, 5)):
+            marker = style
+            for key, seq in MARKERS.items():
+                if key in style:
+                    marker = style.replace(key, seq[k])
+                    break
+            lines.append('{}{}{}'.format(marker,
+                                         '  ' if style in WIDE else ' ',
+                                         _text(rnd, 1, 8)))
+        lines += ['']
+        # a single attribute para, each attribute para resets the others
+        lines += ['answer: {}'.format('abcde'[rnd.randrange(2)]),
+                  'explanation: {}'.format(_text(rnd, 0, 12))]
+        if rnd.random() < 0.3:
+            lines += ['tags: t{}, common'.format(nr % 5)]
+        lines += ['']
+    return '\n'.join(lines) + '\n'
+
+
+def setup(root, numq, images=False, seed=1):
+    'write a generated source below root, returns its filename'
+    os.makedirs(os.path.join(root, 'mantra', 'static'), exist_ok=True)
+    src_dir = os.path.join(root, 'docs', 'bench')
+    os.makedirs(os.path.join(src_dir, 'img'), exist_ok=True)
+    if images:
+        for nr in range(NUM_IMGS):
+            with open(os.path.join(src_dir, 'img',
+                                   'fig{}.png'.format(nr)), 'wb') as fh:
+                fh.write(png(nr))
+    fname = os.path.join(src_dir, 'q{}{}.md'.format(numq,
+                                                    'i' if images else ''))
+    with open(fname, 'wt') as fh:
+        fh.write(generate(numq, images, seed))
+    return fname
+
+
+def du(topdir):
+    'return total size of files below topdir, following symlinks'
+    total = 0
+    for dirname, _, fnames in os.walk(topdir, followlinks=True):
+        total += sum(os.path.getsize(os.path.join(dirname, fname))
+                     for fname in fnames)
+    return total
+
+
+def compile_runs(src, repeat):
+    'compile src repeat times in this process, yield a dict per run'
+    # runs in the scratch root, config must see that as its cwd
+    from config import cfg
+    import bulk
+    import imgstore
+    import qparse
+    import utils
+
+    category = os.path.relpath(os.path.dirname(src), cfg.src_dir)
+    idx = utils.MtrIdx('C', src, category,
+                       utils.get_test_id(cfg.src_dir, src))
+    for run in range(repeat):
+        calls = qparse.PANDOC.stats()['calls']
+        start = time.perf_counter()
+        result = bulk.compile_one(idx)
+        wall = time.perf_counter() - start
+        dst_dir = os.path.join(cfg.dst_dir, idx.test_id)
+        try:
+            with open(os.path.join(dst_dir, qparse.MTR_STATS), 'rt') as fh:
+                metrics = json.load(fh)['metrics']
+        except (OSError, ValueError, KeyError):
+            metrics = {}
+        yield {
+            'src': os.path.basename(src),
+            'run': run,
+            'ok': result.ok,
+            'error': result.error,
+            'questions': result.numq,
+            'wall': round(wall, 4),
+            'pandoc': qparse.PANDOC.stats()['calls'] - calls,
+            'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'pandoc_kb':
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'bytes': du(dst_dir) + du(imgstore.STORE.store_dir),
+            'metrics': metrics,
+        }
+
+
+def _fragments(blocks):
+    'yield each block, and each item of a list, as a fragment of its own'
+    for block in blocks:
+        yield [block]
+        if block['t'] == 'BulletList':
+            yield from block['c']
+        elif block['t'] == 'OrderedList':
+            yield from block['c'][1]
+
+
+def verify_src(src, numq=None):
+    'check compiled output of src against pandoc, returns dict of results'
+    # numq, if given, is the number of questions src must yield
+    # runs in the scratch root, config must see that as its cwd
+    from config import cfg
+    import qparse
+    import utils
+
+    category = os.path.relpath(os.path.dirname(src), cfg.src_dir)
+    idx = utils.MtrIdx('C', src, category,
+                       utils.get_test_id(cfg.src_dir, src))
+
+    def parse(**kwargs):
+        # an empty cache, so neither parse sees results of the other
+        qparse.MD_CACHE = utils.LruCache(cfg.md_cache_size)
+        return [q.to_json() for q in qparse.Parser(idx, **kwargs).parse().qstn]
+
+    ref = parse(batch=False, native=False)
+    new = parse()
+    differ = [nr for nr, (q1, q2) in enumerate(zip(ref, new)) if q1 != q2]
+
+    native, fallback, wrong = 0, 0, []
+    doc = qparse.PandocAst.from_file(src)
+    for fragment in _fragments(doc.ast):
+        try:
+            txt = qparse.MdWriter().write(fragment)
+        except qparse.MdUnsupported:
+            fallback += 1
+            continue
+        native += 1
+        if txt != qparse.PandocAst(fragment)._convert(
+                qparse.PandocAst.FMT, qparse.PandocAst.MD_XTRA):
+            wrong.append(json.dumps(fragment)[:200])
+    return {
+        'src': os.path.basename(src),
+        'ok': len(ref) == len(new) and not differ and not wrong and
+        numq in (None, len(new)),
+        'questions': len(ref),
+        'expected': numq,
+        'differ': differ if len(ref) == len(new) else 'count {} != {}'.format(
+            len(new), len(ref)),
+        'native': native,
+        'fallback': fallback,
+        'wrong': wrong,
+    }
+
+
+def verify_search():
+    'check a search finds the same tests under every sort, returns dict'
+    # the index page sorts on columns of mantra.db or on a snapshot's
+    # (app_tests.test_page), paging must not change with the sort
+    from config import cfg
+    import idxdb
+    import watcher
+
+    src_dir = os.path.join(cfg.src_dir, 'bench')
+    for name in NAMES:
+        with open(os.path.join(src_dir, name), 'wt') as fh:
+            fh.write(generate(2))
+    snap, db = watcher.snapshot(), watcher.db()
+
+    differ = []
+    for search in SEARCHES:
+        for categories in [(), ('bench',)]:
+            found = {}
+            for sort in watcher.Snapshot.SORTS:
+                found[sort] = [idx.test_id for idx in snap.view(
+                    categories=categories, search=search, sort=sort)]
+            for sort in idxdb.IdxRow._fields:
+                found['db ' + sort] = [row.test_id for row in db.query(
+                    category=categories, search=search, sort=sort)]
+            total = db.count(category=categories, search=search)
+            ref = sorted(found['name'])
+            bad = [sort for sort, ids in found.items() if sorted(ids) != ref]
+            if bad or total != len(ref):
+                differ.append('{!r} in {}: {} tests, db.count {}{}'.format(
+                    search, categories or 'all', len(ref), total,
+                    ', other tests by ' + ', '.join(bad) if bad else ''))
+    return {
+        'src': 'search',
+        'ok': not differ,
+        'searches': len(SEARCHES),
+        'tests': len(snap),
+        'differ': differ,
+    }
+
+
+def _worker(root, *args):
+    'run bench.py with args in a fresh process in root, returns its result'
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [here] + [p for p in [env.get('PYTHONPATH')] if p])
+    cmd = [sys.executable, os.path.abspath(__file__)] + list(args)
+    proc = subprocess.run(cmd, cwd=root, env=env, stdout=subprocess.PIPE,
+                          universal_newlines=True)
+    lines = [line for line in proc.stdout.splitlines()
+             if line.startswith('{')]
+    if proc.returncode != 0 or not lines:
+        return None, proc.returncode
+    return json.loads(lines[-1]), proc.returncode
+
+
+def verify(root, src, numq=None):
+    'verify src in a fresh process, returns dict of results'
+    args = ['--check', src]
+    if numq is not None:
+        args += ['--numq', str(numq)]
+    result, code = _worker(root, *args)
+    if result is None:
+        return {'src': src, 'ok': False, 'error': 'exit {}'.format(code)}
+    return result
+
+
+def show_verify(result):
+    'print a single verify result'
+    if 'error' in result:
+        print('FAIL {} {}'.format(result['src'], result['error']), flush=True)
+        return
+    if result['src'] == 'search':
+        print('{:4s} {:>5d} searches in {} tests, under every sort'.format(
+            'ok' if result['ok'] else 'FAIL', result['searches'],
+            result['tests']), flush=True)
+        for differ in result['differ']:
+            print('   search {}'.format(differ))
+        return
+    print('{:4s} {:>5d}q {:>6d} native {:>5d} fallback  {}'.format(
+        'ok' if result['ok'] else 'FAIL', result['questions'],
+        result['native'], result['fallback'], result['src']), flush=True)
+    if result['expected'] not in (None, result['questions']):
+        print('   expected {} questions'.format(result['expected']))
+    if result['differ']:
+        print('   questions differ: {}'.format(result['differ']))
+    for fragment in result['wrong']:
+        print('   native differs: {}'.format(fragment))
+
+
+def bench(root, numq, images, repeat, seed):
+    'compile a generated source in a fresh process, returns list of runs'
+    src = setup(root, numq, images, seed)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [here] + [p for p in [env.get('PYTHONPATH')] if p])
+    cmd = [sys.executable, os.path.abspath(__file__), '--src', src,
+           '-r', str(repeat)]
+    proc = subprocess.run(cmd, cwd=root, env=env, stdout=subprocess.PIPE,
+                          universal_newlines=True)
+    runs = [json.loads(line) for line in proc.stdout.splitlines()
+            if line.startswith('{')]
+    for run in runs:
+        run.update(size=numq, images=images)
+    if proc.returncode != 0 or not runs:
+        runs.append({'size': numq, 'images': images, 'src': src, 'run': -1,
+                     'ok': False, 'error': 'exit {}'.format(proc.returncode)})
+    return runs
+
+
+def _fnv64_ref(category, basename):
+    'test_id as originally computed, ascii only'
+    data = category.encode('ascii') + basename.encode('ascii')
+    hash_n = 0xcbf29ce484222325
+    for b in data:
+        hash_n *= 0x100000001b3
+        hash_n &= 0xffffffffffffffff
+        hash_n ^= b
+    hash_b = struct.pack('<Q', hash_n)
+    return base64.urlsafe_b64encode(hash_b)[:-1].decode('ascii')
+
+
+def bench_hash(count, seed=1):
+    'time test_id hashing of count src paths, returns dict of results'
+    import utils
+    rnd = random.Random(seed)
+    paths = [('cat{}/sub{}'.format(rnd.randrange(count // 500 + 1),
+                                   rnd.randrange(10)),
+              'test{}.md'.format(nr)) for nr in range(count)]
+
+    def timed(func):
+        start = time.perf_counter()
+        ids = [func(category, basename) for category, basename in paths]
+        return time.perf_counter() - start, ids
+
+    ref, ref_ids = timed(_fnv64_ref)
+    utils.hash_test_id.cache_clear()
+    utils._fnv64_prefix.cache_clear()
+    cold, ids = timed(utils.hash_test_id)
+    warm, _ = timed(utils.hash_test_id)
+    return {
+        'paths': count,
+        'same': ids == ref_ids,
+        'utf8': utils.hash_test_id('catégorie', 'vraag.md'),
+        'ref': round(ref, 4),
+        'cold': round(cold, 4),
+        'warm': round(warm, 4),
+        'speedup_cold': round(ref / cold, 1),
+        'speedup_warm': round(ref / warm, 1),
+    }
+
+
+def show(run):
+    'print a single run as a table row'
+    if run['run'] < 0:
+        print('{:>5} {:3s}  FAIL {}'.format(run['size'],
+              'img' if run['images'] else '', run['error']), flush=True)
+        return
+    print('{:>5} {:3s} {:>3} {:4s} {:9.3f}s {:7d} {:9d} {:9d} {:11d}'.format(
+        run['size'], 'img' if run['images'] else '', run['run'],
+        'ok' if run['ok'] else 'FAIL', run['wall'], run['pandoc'],
+        run['rss_kb'], run['pandoc_kb'], run['bytes']), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Mantra compiles')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES,
+                        help='questions per source (default %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='compiles per source, first one is cold')
+    parser.add_argument('--images', choices=['no', 'yes', 'both'],
+                        default='both', help='sources with images or not')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the source generator')
+    parser.add_argument('--root', default=None,
+                        help='scratch root dir (default a temp dir, removed)')
+    parser.add_argument('--json', action='store_true',
+                        help='print runs as json lines instead of a table')
+    parser.add_argument('--hash', type=int, metavar='N',
+                        help='only time test_id hashing of N paths')
+    parser.add_argument('--verify', nargs='*', metavar='SRC',
+                        help='check output against pandoc, not timed')
+    parser.add_argument('--src', help=argparse.SUPPRESS)  # worker mode
+    parser.add_argument('--check', help=argparse.SUPPRESS)  # worker mode
+    parser.add_argument('--numq', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--search', action='store_true',
+                        help=argparse.SUPPRESS)  # worker mode
+    args = parser.parse_args(argv)
+
+    if args.hash:
+        result = bench_hash(args.hash, args.seed)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            for key, val in result.items():
+                print('{:>12s} {}'.format(key, val))
+        return 0 if result['same'] else 1
+
+    if args.src:
+        for run in compile_runs(args.src, args.repeat):
+            print(json.dumps(run), flush=True)
+        return 0
+
+    if args.check:
+        print(json.dumps(verify_src(args.check, args.numq)), flush=True)
+        return 0
+
+    if args.search:
+        print(json.dumps(verify_search()), flush=True)
+        return 0
+
+    root = args.root or tempfile.mkdtemp(prefix='mantra-bench-')
+    images = {'no': [False], 'yes': [True], 'both': [False, True]}
+    if args.verify is not None:
+        report = (lambda result: print(json.dumps(result), flush=True)) \
+            if args.json else show_verify
+        failed = 0
+        try:
+            # generated sources must yield all of their questions
+            srcs = [(setup(root, numq, with_imgs, args.seed), numq)
+                    for numq in args.sizes
+                    for with_imgs in images[args.images]]
+            srcs += [(os.path.abspath(src), None) for src in args.verify]
+            for src, numq in srcs:
+                result = verify(root, src, numq)
+                failed += 0 if result['ok'] else 1
+                report(result)
+            # and searching the index they're in
+            result, code = _worker(root, '--search')
+            if result is None:
+                result = {'src': 'search', 'ok': False,
+                          'error': 'exit {}'.format(code)}
+            failed += 0 if result['ok'] else 1
+            report(result)
+        finally:
+            if args.root is None:
+                shutil.rmtree(root, ignore_errors=True)
+        return 1 if failed else 0
+
+    report = (lambda run: print(json.dumps(run), flush=True)) \
+        if args.json else show
+    if not args.json:
+        print('{:>5} {:3s} {:>3} {:4s} {:>10s} {:>7s} {:>9s} {:>9s} {:>11s}'
+              .format('size', '', 'run', '', 'wall', 'pandoc', 'rss_kb',
+                      'pandoc_kb', 'bytes'))
+    failed = 0
+    try:
+        for numq in args.sizes:
+            for with_imgs in images[args.images]:
+                # each source compiles into a clean mantra dir
+                shutil.rmtree(os.path.join(root, 'mantra'),
+                              ignore_errors=True)
+                for run in bench(root, numq, with_imgs, args.repeat,
+                                 args.seed):
+                    failed += 0 if run['ok'] else 1
+                    report(run)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- encoding: utf8 -*-
+'''
+Bulk compile of tests, using a pool of processes.
+
+Compiles all tests whose output is missing or stale (C and U flags in the
+Mantra index), optionally limited to one or more category subtrees.  Each
+test compiles in its own worker process, so a broken source only fails its
+own test and not the whole batch.
+
+Usage:
+
+python3 bulk.py                     # compile all stale tests
+python3 bulk.py -a net/ipv4         # (re)compile all tests under net/ipv4
+python3 bulk.py -n                  # only list what would be compiled
+'''
+
+import os
+import sys
+import time
+import argparse
+import logging
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+# App imports
+from config import cfg
+import generation
+import imgstore
+import utils
+
+# -- Globals
+log = logging.getLogger(cfg.app_name)
+
+Result = namedtuple('Result', [
+    'test_id',   # test compiled
+    'src',       # its source file
+    'ok',        # True if compiled without errors
+    'secs',      # wall time for this test
+    'numq',      # number of questions compiled
+    'error',     # error message if not ok
+])
+
+
+def select(idxs, categories=None, force=False):
+    'return list of idx entries to compile, sorted by source filename'
+    todo = []
+    for idx in idxs:
+        if idx.flag == 'O':
+            continue  # orphans have no source left to compile
+        if not force and idx.flag not in 'CU':
+            continue
+        if categories and not any(idx.category == cat or
+                                  idx.category.startswith(cat + '/')
+                                  for cat in categories):
+            continue
+        todo.append(idx)
+    return sorted(todo, key=lambda idx: idx.src)
+
+
+def compile_one(idx):
+    'compile a single test in a worker process, returns a Result'
+    # imported here, only workers need the compiler
+    import qparse
+    start = time.perf_counter()
+    logfile = None
+    handler = None
+    try:
+        gen = generation.new(cfg.dst_dir, idx.test_id)
+        logfile = os.path.join(gen, 'mtr.log')
+        handler = logging.FileHandler(logfile)
+        handler.setFormatter(qparse.FORMAT)
+        log.addHandler(handler)
+        log.info('Parsing source: %s', idx.src)
+        p = qparse.compile_test(idx, gen)
+        generation.publish(cfg.dst_dir, idx.test_id, gen)
+        log.info('All done!')
+        ok, numq, error = True, len(p.qstn), ''
+    except Exception as e:
+        log.exception('Compile failed: %r', e)
+        ok, numq, error = False, 0, ''.join(
+            traceback.format_exception_only(type(e), e)).strip()
+        if logfile is not None:
+            error = '{}\n   see {}'.format(error, logfile)
+    finally:
+        if handler is not None:
+            log.removeHandler(handler)
+            handler.close()
+
+    if ok:
+        os.remove(logfile)  # mtr.log is kept only to see what went wrong
+    return Result(idx.test_id, idx.src, ok, time.perf_counter() - start,
+                  numq, error)
+
+
+def _died(idx, err):
+    'return Result for a test whose worker process died'
+    return Result(idx.test_id, idx.src, False, 0.0, 0,
+                  'worker died: {!r}'.format(err))
+
+
+def run(todo, workers=None, report=None):
+    'compile idx entries in todo, returns list of Results'
+    results = []
+    retry = []  # tests in flight when some worker died
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = dict((pool.submit(compile_one, idx), idx) for idx in todo)
+        for job in as_completed(jobs):
+            try:
+                result = job.result()
+            except BrokenProcessPool:
+                retry.append(jobs[job])
+                continue
+            results.append(result)
+            if report:
+                report(result)
+
+    # retry each on its own, so the culprit can't take out the others
+    for idx in retry:
+        try:
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                result = pool.submit(compile_one, idx).result()
+        except BrokenProcessPool as e:
+            result = _died(idx, e)
+        results.append(result)
+        if report:
+            report(result)
+
+    return results
+
+
+def show(result):
+    'print a single result'
+    print('{:4s} {:7.2f}s {:4d}q  {}'.format(
+        'ok' if result.ok else 'FAIL', result.secs, result.numq,
+        os.path.relpath(result.src, cfg.src_dir)), flush=True)
+
+
+def summary(results, wall):
+    'print summary of results & return number of failures'
+    failed = [r for r in results if not r.ok]
+    busy = sum(r.secs for r in results)
+    print()
+    print('compiled {} tests, {} ok, {} failed'.format(
+        len(results), len(results) - len(failed), len(failed)))
+    print('questions {}, wall time {:.2f}s, compile time {:.2f}s'.format(
+        sum(r.numq for r in results), wall, busy))
+    for r in sorted(results, key=lambda r: r.secs, reverse=True)[:5]:
+        print(' - slow {:7.2f}s {}'.format(r.secs, r.src))
+    for r in failed:
+        print(' - FAIL {} ({})\n   {}'.format(r.src, r.test_id, r.error))
+    return len(failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk compile Mantra tests')
+    parser.add_argument('categories', nargs='*',
+                        help='only compile tests in these category subtrees')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='compile all tests, not only stale ones')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default #cpus)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='list tests to compile, but do not compile')
+    args = parser.parse_args(argv)
+
+    # sources may have been edited in place, so stat them all
+    idxs = utils.MantraIdx(cfg.src_dir, cfg.dst_dir, sync=False)
+    idxs.read().sync(full=True)
+    cats = [os.path.normpath(cat).strip('/') for cat in args.categories]
+    todo = select(idxs, cats, args.all)
+    if args.dry_run:
+        for idx in todo:
+            print('{} {} {}'.format(idx.flag, idx.test_id, idx.src))
+        return 0
+
+    print('compiling {} tests using {} processes'.format(len(todo),
+                                                         args.jobs))
+    start = time.perf_counter()
+    results = run(todo, args.jobs, show)
+    failed = summary(results, time.perf_counter() - start)
+    idxs.sync()  # picks up the new outputs
+    generation.collect(cfg.dst_dir)
+    imgstore.STORE.collect()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
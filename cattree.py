@@ -0,0 +1,143 @@
+# -*- encoding: utf8 -*-
+'''
+Tree of test categories, with counts per node.
+
+Categories are nested paths (a/b/c); each node knows the tests filed
+directly under it and, for its whole subtree, the number of tests and
+the number of tests per flag.
+
+A tree is never modified: update() returns a new tree that shares all
+nodes not on the path of a changed test, so each snapshot of the index
+can have its own tree at the cost of the changes only.
+
+Usage:
+
+tree = CategoryTree.build(idxs)        # idxs: MtrIdx entries
+tree = tree.update(removed, added)     # MtrIdx entries gone & new
+tree.node('net/ipv4').count            # tests in net/ipv4 & below
+tree.node('net').flags                 # -> {'P': 10, 'U': 2, ..}
+tree.test_ids(['net', 'sys/disk'])     # test_ids in those subtrees
+tree.categories()                      # [(path, node), ..] depth first
+'''
+
+
+def _parts(category):
+    return [part for part in category.split('/') if part]
+
+
+class CategoryTree(object):
+    'a category node and its subtree, see module docstring'
+    __slots__ = ('count', 'flags', 'tests', 'children')
+
+    def __init__(self, count=0, flags=None, tests=None, children=None):
+        self.count = count                # nr of tests in this subtree
+        self.flags = flags or {}          # flag -> nr of tests in subtree
+        self.tests = tests or {}          # test_id -> flag, this node only
+        self.children = children or {}    # name -> CategoryTree
+
+    def _copy(self):
+        return CategoryTree(self.count, dict(self.flags), self.tests,
+                            self.children)
+
+    def _find(self, path):
+        'return node at path (tuple of names), None if there is none'
+        node = self
+        for name in path:
+            node = node.children.get(name, None)
+            if node is None:
+                return None
+        return node
+
+    @classmethod
+    def build(cls, idxs):
+        'return a new tree holding the idxs'
+        return cls().update((), idxs)
+
+    def update(self, removed=(), added=()):
+        'return a new tree, without removed & with added MtrIdx entries'
+        root = self._copy()
+        nodes = {(): root}  # path -> node of the new tree
+        owned = set()       # id's of dicts only the new tree has
+
+        def own(node, attr):
+            # node's dict attr, copied once so the old tree keeps its own
+            value = getattr(node, attr)
+            if id(value) not in owned:
+                value = dict(value)
+                setattr(node, attr, value)
+                owned.add(id(value))
+            return value
+
+        def copy(path):
+            # node at path in the new tree, copied (or added) when needed
+            node = nodes.get(path, None)
+            if node is None:
+                parent = copy(path[:-1])
+                old = parent.children.get(path[-1], None)
+                node = CategoryTree() if old is None else old._copy()
+                own(parent, 'children')[path[-1]] = node
+                nodes[path] = node
+            return node
+
+        def change(idx, delta):
+            path = tuple(_parts(idx.category))
+            for n in range(len(path) + 1):
+                node = copy(path[:n])
+                node.count += delta
+                node.flags[idx.flag] = node.flags.get(idx.flag, 0) + delta
+                if not node.flags[idx.flag]:
+                    del node.flags[idx.flag]
+            if delta > 0:
+                own(node, 'tests')[idx.test_id] = idx.flag
+            else:
+                own(node, 'tests').pop(idx.test_id, None)
+            return path
+
+        emptied = set(change(idx, -1) for idx in removed)
+        for idx in added:
+            change(idx, 1)
+
+        # drop nodes left without tests, deepest first
+        for path in sorted(emptied, key=len, reverse=True):
+            while path:
+                node = root._find(path)
+                if node is None or node.count > 0:
+                    break
+                del own(copy(path[:-1]), 'children')[path[-1]]
+                nodes.pop(path, None)
+                path = path[:-1]
+        return root
+
+    def node(self, category):
+        'return node for category, None if it has no tests'
+        node = self
+        for part in _parts(category):
+            node = node.children.get(part, None)
+            if node is None:
+                return None
+        return node
+
+    def subtree(self):
+        'yield (relpath, node) for this node and all nodes below it'
+        todo = [('', self)]
+        while todo:
+            path, node = todo.pop()
+            yield path, node
+            for name in sorted(node.children, reverse=True):
+                todo.append(('{}/{}'.format(path, name) if path else name,
+                             node.children[name]))
+
+    def categories(self):
+        'return list of (category, node) below the root, depth first'
+        return [(path, node) for path, node in self.subtree() if path]
+
+    def test_ids(self, categories):
+        'return set of test_ids in the subtrees of categories'
+        ids = set()
+        for category in categories:
+            node = self.node(category)
+            if node is None:
+                continue
+            for _, sub in node.subtree():
+                ids.update(sub.tests)
+        return ids
@@ -19,18 +19,28 @@ log = getLogger('Mantra')     # hardcoded, so logger.py can import config
 #   |
 #   |- <mtr_dir>/                 -> mantra's topdir for output
 #       |- mantra.log                -> log file
-#       |- mantra.idx                -> index of tests (based on src & dst)
+#       |- mantra.db                 -> index of tests (sqlite, see idxdb.py)
 #       |- <dst_dir>/                -> mantra's subdir for compiled output
-#       |       |- <test_id>/        -> <test_id>'s compile dst dir
+#       |       |- .gens/            -> output generations (see generation.py)
+#       |       |- <test_id>/        -> <test_id>'s compile dst dir (symlink)
 #       |            |- mtr.log         -> temp lock & log file
 #       |            |- mtr.idx         -> this test's idx
+#       |            |- mtr.stats       -> metrics of its last compile
 #       |            |- img.idx         -> [(src.img, dst.img), ..] fullpaths
 #       |            |- lead.md         -> leading page for test (< 1st hdr)
 #       |            |- quiz.json       -> src.md's meta data
-#       |            |- qddd.json       -> question in json format
+#       |            |- qstn.pak        -> questions, packed (QuestionPack)
 #       |            |- img/
 #       |                |- img.png     -> images for questions in <test_id>
 #       |
+#       |- <img_store>/
+#       |       |- hashes.json       -> src.img -> (inode, size, mtime, sha256)
+#       |       |- xx/<sha256>.png   -> each image once, linked from img/
+#       |
+#       |- <cache_dir>/
+#       |       |- ast/              -> pandoc ASTs by sha256(src.md,pandoc,..)
+#       |       |- md/               -> markdown by sha256(fragment, fmt,..)
+#       |
 #       |- <static>/
 #           |- css
 #           |- js
@@ -38,7 +48,7 @@ log = getLogger('Mantra')     # hardcoded, so logger.py can import config
 #           |- webfonts
 #
 # -----------------------------------------------------------------------------
-# {path}/src.md, {imgs.png} -> <test_id>/mtr.idx,img.idx,q<d>.json,img/imgs.png
+# {path}/src.md, {imgs.png} -> <test_id>/mtr.idx,img.idx,qstn.pak,img/imgs.png
 # -----------------------------------------------------------------------------
 # Actions on dst:
 # - create   C (cog f013) if src.md newer than test_id/mtr.idx (or its missing)
@@ -50,7 +60,7 @@ log = getLogger('Mantra')     # hardcoded, so logger.py can import config
 # - orphan   O (child f1ae) is a test_id whose src.md has gone missing
 # - COU flags C(reatable), O(rphaned), U(pdatable)
 # -----------------------------------------------------------------------------
-# mantra.idx =  category, src.md, test_id, src_mtime, dst_mtime, C/U/O/I-flags
+# mantra.db  =  category, src.md, test_id, src_mtime, dst_mtime, C/U/O/I-flags
 # mtr.idx    =  category, src.md, test_id, numq, score
 # img.idx    =  [(src.img, dst.img), ..]
 # quiz.json  =  org doc's meta data; grade, maxtime, etc ...
@@ -64,6 +74,8 @@ _DEFAULTS = (
     ('mtr_dir', 'mantra'),           # topdir for mantra stuff under root
     ('dst_dir', 'output'),              # mantra's subdir for compiled output
     ('static', 'static'),               # mantra's subdir for site static's
+    ('cache_dir', 'cache'),             # mantra's subdir for cached data
+    ('img_store', 'images'),            # mantra's subdir for stored images
 
     ('app_name', 'Mantra'),          # toplevel logger name
     ('log_level', 'DEBUG'),          # default log level for all
@@ -75,6 +87,17 @@ _DEFAULTS = (
      ),
 
     ('tst_ext', 'md pd markdown'.split()),
+    ('pandoc', 'pandoc'),            # pandoc binary (name or path)
+    ('pandoc_workers', 0),           # max concurrent pandoc runs, 0 is #cpus
+    ('compile_workers', 2),          # max concurrent compile/query jobs
+    ('job_retention', 60),           # secs to keep results of finished jobs
+    ('job_events', 256),             # max events kept per job, see events.py
+    ('gen_grace', 600),              # secs before old output is removed
+    ('img_workers', 0),              # threads to hash/store images, 0 is #cpus
+    ('ast_cache_mb', 64),            # max size of cached pandoc ASTs (MB)
+    ('md_cache_size', 4096),         # max nr of markdown fragments in memory
+    ('md_cache_mb', 0),              # persist fragments up to x MB, 0 is off
+    ('tests_per_page', 50),          # rows per page of the tests table
     ('logo', '/static/img/mantra-space-age.png'),
     ('favicon', 'img/favicon.ico'),  # no /static/.. (GET /favicon.ico)
 
@@ -111,6 +134,8 @@ abspaths = {
     'mtr_dir': os.path.join(cfg.root, cfg.mtr_dir),
     'dst_dir': os.path.join(cfg.root, cfg.mtr_dir, cfg.dst_dir),
     'static': os.path.join(cfg.root, cfg.mtr_dir, cfg.static),
+    'cache_dir': os.path.join(cfg.root, cfg.mtr_dir, cfg.cache_dir),
+    'img_store': os.path.join(cfg.root, cfg.mtr_dir, cfg.img_store),
     'log_file': os.path.join(cfg.root, cfg.mtr_dir, cfg.log_file)
 }
 
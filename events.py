@@ -0,0 +1,176 @@
+# -*- encoding: utf8 -*-
+'''
+In-memory event bus for Mantra jobs.
+
+A job publishes structured events (stage reached, question n of N,
+warnings, errors) into a bounded ring buffer of its own, so a chatty job
+costs a fixed amount of memory.  Any number of subscribers (UI callbacks,
+the CLI, metrics) read a job's events from a cursor of their own:
+
+- each event has a sequence number, unique across the bus
+- read(job, cursor) returns the events after cursor and the new cursor
+- a reader that falls behind misses the oldest events, which it is told
+- a job's percentage done and its warning/error counts are kept apart from
+  the ring, so they're always available
+- events of finished jobs are kept for `retention` seconds
+
+Usage:
+
+BUS.start(test_id)                        # (re)start test_id's events
+BUS.publish(test_id, 'stage', stage='parse', pct=10)
+BUS.publish(test_id, 'warning', msg='image not found')
+BUS.end(test_id, 'done')
+events, cursor, missed = BUS.read(test_id, cursor, timeout=1)
+BUS.progress(test_id)                     # -> {'pct': 100, 'stage': ..}
+'''
+
+import itertools
+import threading
+import time
+from collections import deque, namedtuple
+import logging
+
+# App imports
+from config import cfg
+
+# -- Globals
+log = logging.getLogger(cfg.app_name)
+log.debug('logging via %s', log.name)
+
+Event = namedtuple('Event', [
+    'seq',      # sequence number, unique across the bus
+    'time',     # when published (epoch)
+    'job',      # job (test_id) that published it
+    'kind',     # start, stage, question, warning, error or end
+    'stage',    # stage the job was in
+    'n',        # for questions, nr of questions done so far
+    'total',    # for questions, nr of questions in the test
+    'pct',      # percentage of the job done
+    'msg',      # text, if any
+])
+
+
+class Ring(object):
+    'events of a single job, at most size of them'
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.lost = 0         # seq of the newest event pushed out
+        self.stage = ''       # latest stage
+        self.pct = 0.0        # latest percentage
+        self.counts = {}      # kind -> nr of events published
+        self.state = 'running'
+        self.finished = 0.0   # time of the end event
+
+    def push(self, event):
+        if len(self.events) == self.events.maxlen:
+            self.lost = self.events[0].seq
+        self.events.append(event)
+        self.counts[event.kind] = self.counts.get(event.kind, 0) + 1
+        self.stage = event.stage
+        self.pct = event.pct
+
+
+class EventBus(object):
+    'rings of events by job, see module docstring'
+
+    def __init__(self, size=256, retention=60):
+        self.size = size             # max events per job
+        self.retention = retention   # seconds to keep a finished job's ring
+        self.rings = {}              # job -> Ring
+        self._seq = itertools.count(1)
+        self._cv = threading.Condition()
+
+    def start(self, job):
+        'start a new ring for job, dropping the events of its last run'
+        with self._cv:
+            self._purge()
+            self.rings[job] = Ring(self.size)
+            self._publish(job, 'start', '', 0, 0, 0.0, '')
+
+    def publish(self, job, kind, stage='', n=0, total=0, pct=0.0, msg=''):
+        'add an event to job\'s ring, starting one if needed'
+        with self._cv:
+            if job not in self.rings:
+                self._purge()
+                self.rings[job] = Ring(self.size)
+            self._publish(job, kind, stage, n, total, pct, msg)
+
+    def end(self, job, state, msg=''):
+        'publish the end event of job, state is done or failed'
+        with self._cv:
+            ring = self.rings.get(job, None)
+            if ring is None:
+                return
+            pct = 100.0 if state == 'done' else ring.pct
+            self._publish(job, 'end', ring.stage, 0, 0, pct, msg)
+            ring.state = state
+            ring.finished = time.time()
+
+    def _publish(self, job, kind, stage, n, total, pct, msg):
+        # called with lock held, wakes up all waiting readers
+        # - events without a stage or pct of their own get the latest ones
+        ring = self.rings[job]
+        ring.push(Event(next(self._seq), time.time(), job, kind,
+                        stage or ring.stage, n, total, max(pct, ring.pct),
+                        msg))
+        self._cv.notify_all()
+
+    def _purge(self):
+        # called with lock held, forget rings past their retention
+        expired = time.time() - self.retention
+        for job in [job for job, ring in self.rings.items()
+                    if ring.finished and ring.finished < expired]:
+            del self.rings[job]
+
+    def read(self, job, cursor=0, timeout=0):
+        'return events after cursor, the new cursor & True if some were lost'
+        # waits up to timeout seconds for new events, if there are none yet
+        deadline = time.time() + timeout
+        with self._cv:
+            while True:
+                ring = self.rings.get(job, None)
+                if ring is not None and ring.events and \
+                        ring.events[-1].seq > cursor:
+                    break
+                wait = deadline - time.time()
+                if wait <= 0 or (ring is not None and ring.finished):
+                    return [], cursor, False
+                self._cv.wait(wait)
+            events = [e for e in ring.events if e.seq > cursor]
+            return events, events[-1].seq, ring.lost > cursor
+
+    def progress(self, job):
+        'return dict with state, stage, pct & event counts of job, or None'
+        with self._cv:
+            ring = self.rings.get(job, None)
+            if ring is None:
+                return None
+            return {
+                'state': ring.state,
+                'stage': ring.stage,
+                'pct': ring.pct,
+                'warnings': ring.counts.get('warning', 0),
+                'errors': ring.counts.get('error', 0),
+                'events': sum(ring.counts.values()),
+            }
+
+
+class EventHandler(logging.Handler):
+    'publish warnings & errors logged by a job as its events'
+
+    def __init__(self, job, bus, level=logging.WARNING):
+        super().__init__(level)
+        self.job = job
+        self.bus = bus
+
+    def emit(self, record):
+        try:
+            kind = 'error' if record.levelno >= logging.ERROR else 'warning'
+            self.bus.publish(self.job, kind, msg=record.getMessage())
+        except Exception:
+            self.handleError(record)
+
+
+# compile jobs of all pages share this bus
+BUS = EventBus(cfg.job_events, retention=cfg.job_retention)
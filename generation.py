@@ -0,0 +1,169 @@
+# -*- encoding: utf8 -*-
+'''
+Generations of compiled test output.
+
+A test's output dir <dst_dir>/<test_id> is a symlink to its current
+generation, a directory under <dst_dir>/.gens.  A compile fills a fresh
+generation and publish() switches the symlink with a single rename, so
+readers see either the old or the new output, never a partial one.
+
+Retired generations are removed by collect(), but only after a grace period
+so readers that are still using one can finish.
+
+Usage:
+
+gen = generation.new(dst_dir, test_id)     # has the current files (links)
+...                                        # write new output to gen
+generation.publish(dst_dir, test_id, gen)  # atomic switch to gen
+generation.collect(dst_dir)                # reclaim retired generations
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import logging
+
+# App imports
+from config import cfg
+
+# -- Globals
+log = logging.getLogger(cfg.app_name)
+log.debug('logging via %s', log.name)
+
+GENS = '.gens'          # subdir of dst_dir holding all generations
+SKIP = ['mtr.log']      # not carried over into a new generation
+
+
+def current(dst_dir, test_id):
+    'return path of test_id\'s current generation, None if there is none'
+    path = os.path.join(dst_dir, test_id)
+    if os.path.islink(path):
+        return os.path.join(dst_dir, os.readlink(path))
+    if os.path.isdir(path):
+        return path  # plain directory, written before generations existed
+    return None
+
+
+def new(dst_dir, test_id):
+    'return a new generation dir for test_id, holding its current files'
+    gens = os.path.join(dst_dir, GENS)
+    os.makedirs(gens, exist_ok=True)
+    gen = tempfile.mkdtemp(prefix='{}.'.format(test_id), dir=gens)
+    os.chmod(gen, 0o755)
+
+    # hard links cost no copying, new output must *replace* these files
+    # rather than write into them, or the current generation changes too
+    src = current(dst_dir, test_id)
+    if src is None:
+        return gen
+    for dirname, _, fnames in os.walk(src):
+        reldir = os.path.relpath(dirname, src)
+        os.makedirs(os.path.join(gen, reldir), exist_ok=True)
+        for fname in fnames:
+            if reldir == '.' and fname in SKIP:
+                continue
+            org = os.path.join(dirname, fname)
+            dst = os.path.join(gen, reldir, fname)
+            try:
+                os.link(org, dst)
+            except OSError:
+                shutil.copy2(org, dst)
+    return gen
+
+
+def _retire(dst_dir, test_id, gen):
+    'mark gen as retired, its grace period starts now'
+    if gen is None or not os.path.isdir(gen):
+        return
+    if not os.path.dirname(gen) == os.path.join(dst_dir, GENS):
+        # a plain directory is moved out of the way first (not atomic)
+        retired = os.path.join(dst_dir, GENS, '{}.{}'.format(
+            test_id, uuid.uuid4().hex[:8]))
+        os.rename(gen, retired)
+        gen = retired
+    os.utime(gen)
+
+
+def publish(dst_dir, test_id, gen):
+    'make gen the current generation of test_id'
+    path = os.path.join(dst_dir, test_id)
+    old = current(dst_dir, test_id)
+    if old == path:
+        _retire(dst_dir, test_id, old)  # plain dir, can't replace by a link
+
+    # a relative link, so dst_dir can move; hidden name for the temp link
+    tmp = os.path.join(dst_dir, '.{}.{}'.format(test_id, uuid.uuid4().hex))
+    os.symlink(os.path.relpath(gen, dst_dir), tmp)
+    os.replace(tmp, path)
+    log.debug('published %s -> %s', path, gen)
+
+    if old not in (None, path, gen):
+        _retire(dst_dir, test_id, old)
+    return gen
+
+
+def remove(dst_dir, test_id):
+    'remove test_id\'s output, its generations are reclaimed by collect()'
+    path = os.path.join(dst_dir, test_id)
+    old = current(dst_dir, test_id)
+    if os.path.islink(path):
+        os.unlink(path)
+    _retire(dst_dir, test_id, old)
+    return old
+
+
+def collect(dst_dir, grace=None):
+    'remove retired generations untouched for grace seconds, returns count'
+    grace = cfg.gen_grace if grace is None else grace
+    gens = os.path.join(dst_dir, GENS)
+    try:
+        names = os.listdir(gens)
+    except FileNotFoundError:
+        return 0
+
+    # all current generations
+    live = set()
+    for name in os.listdir(dst_dir):
+        path = os.path.join(dst_dir, name)
+        if not name.startswith('.') and os.path.islink(path):
+            live.add(os.path.normpath(os.path.join(dst_dir,
+                                                   os.readlink(path))))
+    count = 0
+    expired = time.time() - grace
+    for name in names:
+        gen = os.path.join(gens, name)
+        if gen in live:
+            continue
+        # a generation being compiled is touched through its log regularly
+        touched = [gen, os.path.join(gen, 'mtr.log')]
+        mtime = max(os.path.getmtime(x) for x in touched if os.path.exists(x))
+        if mtime > expired:
+            continue
+        shutil.rmtree(gen, ignore_errors=True)
+        log.debug('collected %s', gen)
+        count += 1
+    return count
+
+
+class Collector(threading.Thread):
+    'background thread that collect()s retired generations periodically'
+
+    def __init__(self, dst_dir, grace=None, interval=60):
+        super().__init__(name='gen-collector', daemon=True)
+        self.dst_dir = dst_dir
+        self.grace = grace
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                collect(self.dst_dir, self.grace)
+            except OSError:
+                log.exception('collecting generations in %s', self.dst_dir)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,242 @@
+# -*- encoding: utf8 -*-
+'''
+SQLite store for the Mantra index (see utils.MantraIdx).
+
+The index lives in a single sqlite database (WAL mode) next to dst_dir:
+
+- state: the dirs, srcs & dsts MantraIdx syncs against, one row each
+- tests: one row per test, with indexed columns to query the index on
+- meta:  version, src filter and the like
+
+A save writes only rows that changed, in one transaction.  With WAL, page
+callbacks keep reading while compiles or the index watcher write, and
+every thread uses a connection of its own.
+
+Usage:
+
+db = IdxDB(fname)
+db.query(flags='CU', category='net', sort='numq', desc=True, limit=25)
+db.query(test_ids=[id1, id2])         # rows of these tests
+db.count(category=['net', 'sys'])     # tests in net, sys & their subcategories
+db.set_score(test_id, 87.5)           # kept when the test is synced again
+'''
+
+import json
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+import logging
+
+# -- Globals
+log = logging.getLogger('Mantra')  # hard coded: utils imports this module
+log.debug('logging via %s', log.name)
+
+IdxRow = namedtuple('IdxRow', [
+    'test_id',    # test's id, also the name of its output dir
+    'flag',       # C, U, P or O (see config.py)
+    'src',        # abspath to source file
+    'category',   # subdir(s) under src_dir
+    'src_mtime',  # mtime_ns of its source, None for orphans
+    'dst_mtime',  # mtime_ns of its mtr.idx, None if never compiled
+    'numq',       # number of questions at the last compile
+    'duration',   # secs taken by the last compile
+    'compiled',   # time of the last compile (epoch)
+    'score',      # set by set_score(), None until then
+])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    kind TEXT,
+    key TEXT,
+    value TEXT,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tests (
+    test_id TEXT PRIMARY KEY,
+    flag TEXT NOT NULL,
+    src TEXT NOT NULL,
+    category TEXT NOT NULL,
+    src_mtime INTEGER,
+    dst_mtime INTEGER,
+    numq INTEGER,
+    duration REAL,
+    compiled REAL,
+    score REAL
+);
+CREATE INDEX IF NOT EXISTS tests_category ON tests (category);
+CREATE INDEX IF NOT EXISTS tests_flag ON tests (flag);
+CREATE INDEX IF NOT EXISTS tests_src_mtime ON tests (src_mtime);
+CREATE INDEX IF NOT EXISTS tests_dst_mtime ON tests (dst_mtime);
+CREATE INDEX IF NOT EXISTS tests_numq ON tests (numq);
+CREATE INDEX IF NOT EXISTS tests_duration ON tests (duration);
+CREATE INDEX IF NOT EXISTS tests_score ON tests (score);
+'''
+
+# sync owns all columns of tests but score
+UPSERT = '''
+INSERT INTO tests ({0}) VALUES ({1})
+ON CONFLICT (test_id) DO UPDATE SET {2}
+'''.format(', '.join(IdxRow._fields[:-1]),
+           ', '.join('?' * (len(IdxRow._fields) - 1)),
+           ', '.join('{0}=excluded.{0}'.format(col)
+                     for col in IdxRow._fields[1:-1]))
+
+
+def src_name(src):
+    'a test\'s name, as searched for: its lowercased src filename'
+    return os.path.basename(src).lower()
+
+
+class IdxDB(object):
+    'sqlite store of the index, see module docstring'
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._tls = threading.local()
+
+    @property
+    def db(self):
+        'this thread\'s connection, opened on first use'
+        conn = getattr(self._tls, 'conn', None)
+        if conn is None:
+            # autocommit, transactions are explicit
+            conn = sqlite3.connect(self.fname, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('src_name', 1, src_name, deterministic=True)
+            conn.executescript(SCHEMA)
+            self._tls.conn = conn
+        return conn
+
+    def close(self):
+        'close this thread\'s connection'
+        conn = getattr(self._tls, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._tls.conn = None
+
+    def load(self):
+        'return dict with meta, dirs, srcs, dsts & tests (rows) as stored'
+        state = {'meta': {}, 'dirs': {}, 'srcs': {}, 'dsts': {}, 'tests': {}}
+        db = self.db
+        db.execute('BEGIN')  # a consistent view, even if others write
+        try:
+            for key, value in db.execute('SELECT key, value FROM meta'):
+                state['meta'][key] = json.loads(value)
+            for kind, key, value in db.execute(
+                    'SELECT kind, key, value FROM state'):
+                state[kind][key] = json.loads(value)
+            for row in db.execute('SELECT * FROM tests'):
+                state['tests'][row[0]] = IdxRow(*row)
+        finally:
+            db.execute('COMMIT')
+        return state
+
+    def save(self, meta, changes, tests, clear=False):
+        'write meta, state changes & test rows, all in one transaction'
+        # - changes, list of (kind, key, value), value None deletes the row
+        # - tests, list of (test_id, IdxRow), IdxRow None deletes the row
+        # - clear, drop all state rows & the tests rows not in tests
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if clear:
+                db.execute('DELETE FROM state')
+                # tests rows are upserted, so their scores are kept
+                keep = set(test_id for test_id, row in tests
+                           if row is not None)
+                db.executemany('DELETE FROM tests WHERE test_id = ?', [
+                    (test_id,) for test_id, in db.execute(
+                        'SELECT test_id FROM tests').fetchall()
+                    if test_id not in keep])
+            db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                           [(k, json.dumps(v)) for k, v in meta.items()])
+            db.executemany(
+                'INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                [(kind, key, json.dumps(value))
+                 for kind, key, value in changes if value is not None])
+            db.executemany(
+                'DELETE FROM state WHERE kind = ? AND key = ?',
+                [(kind, key) for kind, key, value in changes
+                 if value is None])
+            db.executemany(UPSERT, [row[:-1] for _, row in tests
+                                    if row is not None])
+            db.executemany('DELETE FROM tests WHERE test_id = ?',
+                           [(test_id,) for test_id, row in tests
+                            if row is None])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        log.debug('saved %d state and %d test rows to %s', len(changes),
+                  len(tests), self.fname)
+        return self
+
+    def set_score(self, test_id, score):
+        'record score for test_id, returns True if the test exists'
+        cur = self.db.execute('UPDATE tests SET score = ? WHERE test_id = ?',
+                              (score, test_id))
+        return cur.rowcount > 0
+
+    # -- queries
+
+    @staticmethod
+    def _where(flags=None, category=None, search=None, test_ids=None):
+        'return sql where clause & its args for the given filters'
+        clauses, args = [], []
+        if flags:
+            clauses.append('flag IN ({})'.format(', '.join('?' * len(flags))))
+            args.extend(flags)
+        if category:
+            # categories themselves and their subcategories, using the index
+            categories = [category] if isinstance(category, str) \
+                else category
+            clauses.append('({})'.format(' OR '.join(
+                ['(category = ? OR (category >= ? AND category < ?))'] *
+                len(categories))))
+            for category in categories:
+                category = category.rstrip('/')
+                args.extend([category, category + '/', category + '0'])
+        if test_ids is not None:
+            clauses.append('test_id IN ({})'.format(
+                ', '.join('?' * len(test_ids))))
+            args.extend(test_ids)
+        search = (search or '').strip().lower()
+        if search:
+            # a plain substring test, so the same tests match as in a
+            # watcher.Snapshot view (LIKE would need escaping & folds ASCII)
+            clauses.append('instr(src_name(src), ?) > 0')
+            args.append(search)
+        if not clauses:
+            return '', args
+        return ' WHERE ' + ' AND '.join(clauses), args
+
+    def query(self, flags=None, category=None, search=None, sort='src',
+              desc=False, limit=None, offset=0, test_ids=None):
+        'return list of IdxRow\'s that match, sorted and paginated'
+        # - flags, string (or list) of flags to include
+        # - category, include this category (or list of them) and its
+        #   subcategories
+        # - search, (case insensitive) substring of the src filename
+        # - test_ids, only (some of) these tests
+        if sort not in IdxRow._fields:
+            raise ValueError('cannot sort on {!r}'.format(sort))
+        where, args = self._where(flags, category, search, test_ids)
+        sql = 'SELECT * FROM tests{} ORDER BY {} {}, test_id'.format(
+            where, sort, 'DESC' if desc else 'ASC')
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            args.extend([limit, offset])
+        return [IdxRow(*row) for row in self.db.execute(sql, args)]
+
+    def count(self, flags=None, category=None, search=None):
+        'return number of tests that match'
+        where, args = self._where(flags, category, search)
+        sql = 'SELECT COUNT(*) FROM tests{}'.format(where)
+        return self.db.execute(sql, args).fetchone()[0]
@@ -0,0 +1,263 @@
+# -*- encoding: utf8 -*-
+'''
+Content addressed store for the images of compiled tests.
+
+Each distinct image is stored once under <mtr_dir>/<img_store>, named by the
+sha256 of its contents.  A test's output refers to it through a hard link
+(or a reflink/copy if the filesystem can't link), so an image used by many
+tests takes up disk space only once and a recompile copies nothing.
+
+- images are hashed & ingested by a pool of threads
+- hashes are cached by (inode, size, mtime), unchanged sources aren't read
+- a stored image without links (st_nlink == 1) is no longer used by any
+  test output and is removed by collect()
+- unless it was ever copied into a test output (the store is on another
+  filesystem), since a copy doesn't count as a link.  These are kept.
+
+Usage:
+
+store = ImageStore(cfg.img_store)
+store.place([(src, dst), ..], stats)  # link dst's to stored src copies
+store.collect()                   # remove images no test refers to
+'''
+
+import os
+import shutil
+import hashlib
+import json
+import threading
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# App imports
+from config import cfg
+
+# -- Globals
+log = logging.getLogger(cfg.app_name)
+log.debug('logging via %s', log.name)
+
+FICLONE = 0x40049409    # linux ioctl to reflink a file (btrfs, xfs, ..)
+HASHES = 'hashes.json'  # the hash cache, in the store's topdir
+CLONES = 'clones.json'  # stored images copied instead of linked, ditto
+
+
+def _tmpname(path):
+    'return a unique temporary name next to path'
+    return '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
+
+
+def reflink(src, dst):
+    'clone src to dst sharing its data blocks, raises OSError if impossible'
+    import fcntl  # not available on all platforms
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def clone(src, dst):
+    'copy src to dst, as a reflink if possible'
+    try:
+        reflink(src, dst)
+    except (ImportError, OSError):
+        shutil.copyfile(src, dst)
+
+
+class ImageStore(object):
+    'images stored by their content hash, linked into test outputs'
+
+    def __init__(self, store_dir, workers=None):
+        self.store_dir = store_dir
+        self.workers = workers or os.cpu_count() or 2
+        self.hashes = None           # src -> [ino, size, mtime_ns, sha256]
+        self.clones = None           # names of stored images ever copied
+        self.dirty = False           # hash cache or clones need saving
+        self.hashed = 0              # nr of files actually read & hashed
+        self.ingested = 0            # nr of new images added to the store
+        self.linked = 0              # nr of dst's (re)linked to the store
+        self._lock = threading.Lock()
+
+    def _load(self):
+        'load the hash cache & clones (once)'
+        if self.hashes is not None:
+            return
+        try:
+            with open(os.path.join(self.store_dir, HASHES), 'rt') as fh:
+                self.hashes = json.load(fh)
+        except (OSError, ValueError):
+            self.hashes = {}
+        try:
+            with open(os.path.join(self.store_dir, CLONES), 'rt') as fh:
+                self.clones = set(json.load(fh))
+        except (OSError, ValueError):
+            self.clones = set()
+
+    def save(self):
+        'save the hash cache & clones, if changed'
+        with self._lock:
+            if not self.dirty:
+                return
+            os.makedirs(self.store_dir, exist_ok=True)
+            for name, data in [(HASHES, self.hashes),
+                               (CLONES, sorted(self.clones))]:
+                fname = os.path.join(self.store_dir, name)
+                tmp = _tmpname(fname)
+                with open(tmp, 'wt') as fh:
+                    json.dump(data, fh)
+                os.replace(tmp, fname)
+            self.dirty = False
+
+    def path(self, digest, ext=''):
+        'return path of stored image for digest'
+        return os.path.join(self.store_dir, digest[:2], digest + ext)
+
+    def checksum(self, src, st=None):
+        'return sha256 hexdigest of src, read only if it changed'
+        st = os.stat(src) if st is None else st
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        with self._lock:
+            self._load()
+            cached = self.hashes.get(src, None)
+        if cached is not None and cached[:3] == key:
+            return cached[3]
+
+        sha = hashlib.sha256()
+        with open(src, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 16), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self._lock:
+            self.hashes[src] = key + [digest]
+            self.dirty = True
+            self.hashed += 1
+        return digest
+
+    def ingest(self, src, st=None):
+        'return path of stored copy of src, adding it if needed'
+        ext = os.path.splitext(src)[1].lower()
+        path = self.path(self.checksum(src, st), ext)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # never link src itself: editing it would change the stored copy
+            tmp = _tmpname(path)
+            clone(src, tmp)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, path)
+            with self._lock:
+                self.ingested += 1
+            log.debug('stored %s as %s', src, path)
+        return path
+
+    def link(self, path, dst):
+        'make dst refer to stored image path, returns True if dst changed'
+        try:
+            if os.path.samefile(path, dst):
+                return False
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = _tmpname(dst)
+        try:
+            os.link(path, tmp)
+        except OSError:
+            clone(path, tmp)  # eg. store is on another filesystem
+            # dst is no link, so collect() can't tell path is still in use
+            with self._lock:
+                self._load()
+                if os.path.basename(path) not in self.clones:
+                    self.clones.add(os.path.basename(path))
+                    self.dirty = True
+        os.replace(tmp, dst)
+        with self._lock:
+            self.linked += 1
+        return True
+
+    def _place(self, src, dsts, st=None):
+        'ingest src and link its dsts, returns list of (dst, msg)'
+        try:
+            if st is None:
+                raise FileNotFoundError(src)
+            path = self.ingest(src, st)
+        except FileNotFoundError:
+            log.error(' - skip missing src %s', src)
+            return []
+        msgs = []
+        for dst in dsts:
+            try:
+                changed = self.link(path, dst)
+            except FileNotFoundError:
+                # collect() removed it in the meantime, store it again
+                changed = self.link(self.ingest(src), dst)
+            msgs.append((dst, 'add' if changed else 'keep'))
+        return msgs
+
+    def place(self, src_dst, stats):
+        'make each dst refer to a stored copy of its src, returns list of msgs'
+        # stats is a utils.StatCache, the srcs are stat'ed in one batch
+        todo = {}
+        for src, dst in src_dst:
+            todo.setdefault(src, []).append(dst)
+        sts = stats.stat_many(todo)
+        work = [(src, dsts, sts[src]) for src, dsts in todo.items()]
+        if len(todo) < 2:
+            results = [self._place(*args) for args in work]
+        else:
+            with ThreadPoolExecutor(min(self.workers, len(todo))) as pool:
+                results = list(pool.map(lambda args: self._place(*args),
+                                        work))
+        self.save()
+        return [msg for msgs in results for msg in msgs]
+
+    def collect(self):
+        'remove stored images no longer linked to by any test, returns count'
+        with self._lock:
+            self._load()
+            clones = set(self.clones)
+        count, stored = 0, set()
+        for dirname, _, fnames in os.walk(self.store_dir):
+            if dirname == self.store_dir:
+                continue  # only the hash cache & clones live here
+            for fname in fnames:
+                if fname.endswith('.tmp'):
+                    continue  # being ingested right now
+                stored.add(fname)
+                if fname in clones:
+                    continue  # copies of it may still be in use
+                path = os.path.join(dirname, fname)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        count += 1
+                except OSError:
+                    log.exception('collecting %s', path)
+
+        # forget hashes of sources that are gone, and clones as well
+        with self._lock:
+            for src in [s for s in self.hashes if not os.path.exists(s)]:
+                del self.hashes[src]
+                self.dirty = True
+            if not clones <= stored:
+                self.clones -= clones - stored
+                self.dirty = True
+        self.save()
+        log.debug('collected %d images from %s', count, self.store_dir)
+        return count
+
+    def stats(self):
+        'return dict with store statistics'
+        with self._lock:
+            return {
+                'hashed': self.hashed,
+                'ingested': self.ingested,
+                'linked': self.linked,
+                'cached': len(self.hashes or {}),
+                'clones': len(self.clones or ()),
+            }
+
+
+# all compiles in this process share the hash cache
+STORE = ImageStore(cfg.img_store, cfg.img_workers)
@@ -0,0 +1,220 @@
+# -*- encoding: utf8 -*-
+'''
+Job scheduler for Mantra.
+
+Runs jobs (compiles, queries) on a bounded pool of worker threads, so a
+burst of requests doesn't start a burst of pandoc-heavy threads.
+
+- jobs wait in a FIFO queue per priority lane, INTERACTIVE before BACKGROUND
+- a job's key (eg ('compile', test_id)) identifies it: submitting a key that
+  is already queued or running returns the existing job
+- a job's state goes queued -> running -> done|failed, finished jobs are
+  kept for `retention` seconds so callbacks can pick up their results
+- a running job's thread is named after the job, so ThreadFilter'd log
+  handlers still work
+
+Usage:
+
+job = SCHEDULER.submit(('compile', test_id), func, name=test_id)
+SCHEDULER.position(('compile', test_id))  # -> 3, ie 3rd in line
+SCHEDULER.job(('compile', test_id)).state # -> 'queued'
+SCHEDULER.stats()                         # -> queue depth, wait/run times
+'''
+
+import heapq
+import itertools
+import threading
+import time
+import logging
+
+# App imports
+from config import cfg
+
+# -- Globals
+log = logging.getLogger(cfg.app_name)
+log.debug('logging via %s', log.name)
+
+# priority lanes, lower runs first
+INTERACTIVE = 0   # user is waiting for it
+BACKGROUND = 1    # sweeps, bulk work
+
+
+class Job(object):
+    'a unit of work for the Scheduler'
+
+    def __init__(self, key, func, name, priority):
+        self.key = key
+        self.func = func
+        self.name = name            # thread name while running
+        self.priority = priority
+        self.state = 'queued'       # -> running -> done|failed
+        self.error = None           # exception raised by func, if any
+        self.result = None          # func's return value, if done
+        self.queued = time.time()
+        self.started = 0.0
+        self.finished = 0.0
+        self._entry = None          # current (priority, seq, job) in queue
+
+    def __repr__(self):
+        return 'Job({!r}, {})'.format(self.key, self.state)
+
+    @property
+    def wait(self):
+        'seconds spent (so far) waiting in the queue'
+        return (self.started or time.time()) - self.queued
+
+    @property
+    def runtime(self):
+        'seconds spent (so far) running'
+        if not self.started:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def active(self):
+        'True if job is queued or running'
+        return self.state in ('queued', 'running')
+
+    def recent(self, secs):
+        'True if job is active or finished less than secs ago'
+        return self.active or time.time() - self.finished < secs
+
+
+class Scheduler(object):
+    'run jobs on at most `workers` threads, by priority, then FIFO'
+
+    def __init__(self, workers=2, name='job', retention=60):
+        self.workers = max(1, workers)
+        self.name = name             # worker thread name prefix
+        self.retention = retention   # seconds to keep finished jobs
+        self.jobs = {}               # key -> Job (active or retained)
+        self.done = 0                # nr of jobs done
+        self.failed = 0              # nr of jobs failed
+        self.waited = 0.0            # cumulative wait time of started jobs
+        self.busy = 0.0              # cumulative run time of finished jobs
+        self._queue = []             # heap of [priority, seq, job]
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self._threads = []
+
+    def submit(self, key, func, name=None, priority=BACKGROUND):
+        'queue func() as job key, unless key is queued/running already'
+        with self._cv:
+            self._purge()
+            job = self.jobs.get(key, None)
+            if job is not None and job.active:
+                if job.state == 'queued' and priority < job.priority:
+                    job.priority = priority   # promote to a faster lane
+                    self._push(job)
+                log.debug('%r merged with %r', key, job)
+                return job
+
+            job = Job(key, func, name or str(key), priority)
+            self.jobs[key] = job
+            self._push(job)
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, daemon=True,
+                                          name='{}-{}'.format(
+                                              self.name, len(self._threads)))
+                self._threads.append(thread)
+                thread.start()
+            self._cv.notify()
+            log.debug('queued %r, depth %d', job, self.depth())
+            return job
+
+    def _push(self, job):
+        # called with lock held, a job's older entry becomes stale
+        job._entry = (job.priority, next(self._seq), job)
+        heapq.heappush(self._queue, job._entry)
+
+    def _pop(self):
+        # called with lock held, returns next job or None
+        while len(self._queue):
+            entry = heapq.heappop(self._queue)
+            if entry is entry[2]._entry:
+                return entry[2]
+        return None
+
+    def _worker(self):
+        'take jobs off the queue and run them, forever'
+        me = threading.current_thread()
+        idle_name = me.name
+        while True:
+            with self._cv:
+                job = self._pop()
+                while job is None:
+                    self._cv.wait()
+                    job = self._pop()
+                job._entry = None
+                job.state = 'running'
+                job.started = time.time()
+                self.waited += job.wait
+
+            me.name = job.name
+            try:
+                job.result = job.func()
+                state = 'done'
+            except Exception as e:
+                log.exception('job %r failed', job.key)
+                job.error = e
+                state = 'failed'
+            finally:
+                me.name = idle_name
+
+            with self._cv:
+                job.finished = time.time()
+                job.state = state
+                self.busy += job.runtime
+                if state == 'done':
+                    self.done += 1
+                else:
+                    self.failed += 1
+            log.debug('%r finished in %.4fs', job, job.runtime)
+
+    def _purge(self):
+        # called with lock held, forget jobs past their retention
+        expired = time.time() - self.retention
+        for key in [key for key, job in self.jobs.items()
+                    if not job.active and job.finished < expired]:
+            del self.jobs[key]
+
+    def job(self, key):
+        'return job for key, None if not found (or expired)'
+        with self._cv:
+            self._purge()
+            return self.jobs.get(key, None)
+
+    def position(self, key):
+        'return place in line for a queued job key (1 is next), else 0'
+        with self._cv:
+            job = self.jobs.get(key, None)
+            if job is None or job._entry is None:
+                return 0
+            return 1 + sum(1 for entry in self._queue
+                           if entry is entry[2]._entry and entry < job._entry)
+
+    def depth(self):
+        'return number of jobs waiting to run'
+        with self._cv:
+            return sum(1 for job in self.jobs.values()
+                       if job.state == 'queued')
+
+    def stats(self):
+        'return dict with scheduler statistics'
+        with self._cv:
+            started = self.done + self.failed + sum(
+                1 for job in self.jobs.values() if job.state == 'running')
+            finished = self.done + self.failed
+            return {
+                'workers': self.workers,
+                'queued': self.depth(),
+                'running': started - finished,
+                'done': self.done,
+                'failed': self.failed,
+                'wait': self.waited / started if started else 0.0,
+                'runtime': self.busy / finished if finished else 0.0,
+            }
+
+
+# compile & query jobs of all pages share this scheduler
+SCHEDULER = Scheduler(cfg.compile_workers, retention=cfg.job_retention)
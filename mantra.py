@@ -13,6 +13,9 @@ import dash_html_components as html
 import logger  # Only mantra.py imports logger -> creates root logger for all
 from config import cfg
 import utils
+import generation
+import imgstore
+import watcher
 from app import app
 import app_tests
 import app_review
@@ -34,12 +37,22 @@ for msg in config.errors:
 for msg in config.warnings:
     log.warning(msg)
 
-utils.MantraIdx(config.cfg.src_dir, config.cfg.dst_dir).save()
+# keep the index of tests current, starts with a full sync
+watcher.start(cfg.src_dir, cfg.dst_dir)
 
 # remove lingering mtr.log files (server interrupted during compile)
-for fname in utils.glob_files(cfg.dst_dir, ['[!.]*/mtr.log']):
-    log.debug('removing residue (%s)', fname)
-    os.remove(os.path.join(cfg.dst_dir, fname))
+stats = utils.StatCache()
+logs = [os.path.join(cfg.dst_dir, name, 'mtr.log')
+        for name in os.listdir(cfg.dst_dir) if not name.startswith('.')]
+for fname, st in stats.stat_many(logs).items():
+    if st is not None:
+        log.debug('removing residue (%s)', fname)
+        os.remove(fname)
+log.debug('residue stats: %s', stats.counts())
+
+# reclaim retired output generations in the background
+generation.Collector(cfg.dst_dir).start()
+imgstore.STORE.collect()  # and images no longer in use
 
 
 # - Helpers
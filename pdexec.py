@@ -0,0 +1,336 @@
+# -*- encoding: utf8 -*-
+'''
+Pandoc executor for Mantra.
+
+Finds the pandoc binary and probes its version only once, limits the number
+of concurrent pandoc runs across all (compiler) threads and keeps track of
+each run's latency.
+
+Pandoc runs either via:
+- a long-lived `pandoc server` (pandoc >= 3.0), if it works, or
+- a plain pandoc subprocess per run (the fallback).
+
+Mantra works with the JSON AST layout of pandoc < 1.18, ie. a list
+[{'unMeta': meta}, blocks].  Newer pandocs use a dict with their
+'pandoc-api-version', meta & blocks, so for those the executor:
+- translates JSON input & output to & from the old layout,
+- reads markdown without implicit_figures, so images stay inline (pandoc 3
+  puts an image on its own in a Figure block, Mantra expects a Para),
+- replaces --atx-header by its successor --markdown-headings=atx.
+
+Usage:
+
+executor = Executor(workers=4)
+txt = executor.convert_text('*hi*', 'html', 'markdown')
+ast = executor.convert_file('test.md', 'json', 'markdown+fancy_lists')
+'''
+
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import json
+import http.client
+import atexit
+import logging
+
+# -- Globals
+log = logging.getLogger('Mantra')  # hard coded: avoid import config
+log.debug('logging via %s', log.name)
+
+
+class PandocError(Exception):
+    pass
+
+
+def which(pandoc='pandoc'):
+    'return full path to pandoc binary or None if not found'
+    path = shutil.which(pandoc)
+    if path is None:
+        try:
+            # pypandoc knows where its own (binary) pandoc install lives
+            import pypandoc
+            path = pypandoc.get_pandoc_path()
+        except (ImportError, OSError):
+            path = None
+    return path
+
+
+def probe(pandoc):
+    'return pandoc version as tuple of ints, () if unknown'
+    try:
+        out = subprocess.run([pandoc, '--version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, timeout=30).stdout
+        # first line reads like: pandoc 1.19.2.1
+        version = out.decode('utf8').splitlines()[0].split()[-1]
+        return tuple(int(x) for x in version.split('.') if x.isdigit())
+    except (OSError, IndexError, subprocess.SubprocessError):
+        return ()
+
+
+def api_version(pandoc):
+    'return pandoc-api-version used in JSON by pandoc, None if pre 1.18'
+    try:
+        out = subprocess.run([pandoc, '--from', 'markdown', '--to', 'json'],
+                             input=b'', stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, timeout=30).stdout
+        doc = json.loads(out.decode('utf8'))
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+    return doc.get('pandoc-api-version', None) if isinstance(doc, dict) \
+        else None
+
+
+class PandocServer(object):
+    'a `pandoc server` process, taking conversion requests over http'
+    # cli args that have a server option, others require a subprocess
+    OPTIONS = {
+        '--standalone': ('standalone', True),
+        '-s': ('standalone', True),
+        '--atx-header': ('markdown-headings', 'atx'),
+    }
+
+    def __init__(self, pandoc, timeout=60):
+        self.pandoc = pandoc
+        self.timeout = timeout
+        self.port = None
+        self.proc = None
+        self.tls = threading.local()  # a keep-alive connection per thread
+
+    @classmethod
+    def options(cls, args):
+        'return dict of server options for cli args, None if not possible'
+        opts = {}
+        for arg in args or []:
+            if arg in cls.OPTIONS:
+                key, val = cls.OPTIONS[arg]
+            elif arg.startswith('--') and '=' in arg:
+                key, val = arg[2:].split('=', 1)
+                if key not in ('markdown-headings', 'wrap', 'columns'):
+                    return None
+                val = int(val) if val.isdigit() else val
+            else:
+                return None
+            opts[key] = val
+        return opts
+
+    def start(self):
+        'start server and return self, or None if it is not available'
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        cmd = [self.pandoc, 'server', '--port', str(self.port),
+               '--timeout', str(self.timeout)]
+        try:
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+
+        # wait for it to come up & see if it actually converts something
+        for _ in range(20):
+            if self.proc.poll() is not None:
+                break
+            try:
+                ok = self.convert('ok', 'plain', 'markdown').strip() == 'ok'
+            except (OSError, http.client.HTTPException):
+                time.sleep(0.1)  # not listening yet
+                continue
+            except PandocError:
+                ok = False       # listening, but not converting
+            if ok:
+                log.debug('pandoc server listening on port %s', self.port)
+                atexit.register(self.stop)
+                return self
+            break
+
+        log.debug('pandoc server not available, using subprocesses')
+        self.stop()
+        return None
+
+    def stop(self):
+        'terminate the server process'
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        self.proc = None
+
+    def convert(self, text, to, frm, opts=None):
+        'return text converted by the server'
+        body = dict(opts or {}, text=text, to=to)
+        body['from'] = frm
+        conn = getattr(self.tls, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                              timeout=self.timeout)
+            self.tls.conn = conn
+        try:
+            conn.request('POST', '/', body=json.dumps(body).encode('utf8'),
+                         headers={'Content-Type': 'application/json',
+                                  'Accept': 'application/json'})
+            rsp = conn.getresponse()
+            data = rsp.read()
+        except (OSError, http.client.HTTPException):
+            self.tls.conn = None  # reconnect next time around
+            conn.close()
+            raise
+        if rsp.status != 200:
+            raise PandocError('pandoc server: {} {}'.format(
+                rsp.status, data.decode('utf8', 'replace')))
+        rv = json.loads(data.decode('utf8'))
+        if rv.get('error'):
+            raise PandocError('pandoc server: {}'.format(rv['error']))
+        # binary output formats are base64 encoded, not used by Mantra
+        return rv['output']
+
+
+class Executor(object):
+    '''
+    Run pandoc, at most `workers` at the same time across all threads.
+
+    The pandoc binary is located and its version probed on first use (or
+    by locate() if only the version is needed).
+    '''
+
+    def __init__(self, pandoc='pandoc', workers=None, server=True):
+        self.pandoc = pandoc           # name or path of the pandoc binary
+        self.workers = workers or os.cpu_count() or 2
+        self.use_server = server       # try `pandoc server` if available
+        self.path = None               # full path to pandoc
+        self.version = ()              # pandoc version as tuple of ints
+        self.api = None                # pandoc-api-version, None if < 1.18
+        self.server = None             # PandocServer, if available
+        self.calls = 0                 # number of pandoc runs
+        self.busy = 0.0                # cumulative run time
+        self.wait = 0.0                # cumulative wait time for a worker
+        self.slowest = 0.0             # longest run time
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def locate(self):
+        'locate pandoc & probe its version (once), returns self'
+        with self._lock:
+            if self.path is None:
+                path = which(self.pandoc)
+                if path is None:
+                    raise PandocError('pandoc {!r} not found'.format(
+                        self.pandoc))
+                self.version = probe(path)
+                if self.version >= (1, 18):
+                    self.api = api_version(path)
+                self.path = path
+                log.debug('using pandoc %s (%s, api %s), %d workers',
+                          '.'.join(map(str, self.version)), self.path,
+                          self.api, self.workers)
+        return self
+
+    def setup(self):
+        'locate pandoc & start its server, if available (once)'
+        self.locate()
+        with self._lock:
+            if self._ready:
+                return self
+            if self.use_server and self.version >= (3, 0):
+                self.server = PandocServer(self.path).start()
+            self._ready = True
+        return self
+
+    def stats(self):
+        'return dict with pandoc run statistics'
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'busy': self.busy,
+                'wait': self.wait,
+                'slowest': self.slowest,
+                'mean': self.busy / self.calls if self.calls else 0.0,
+                'workers': self.workers,
+                'server': self.server is not None,
+            }
+
+    def _args(self, frm, args):
+        'return frm & args, adapted to the pandoc in use'
+        if self.api is None:
+            return frm, args
+        if frm.startswith('markdown') and self.version >= (3, 0):
+            frm += '-implicit_figures'
+        if self.version >= (2, 11, 2):
+            args = ['--markdown-headings=atx' if arg == '--atx-header' else
+                    arg for arg in args or []]
+        return frm, args
+
+    def _to_api(self, text):
+        'return old layout JSON text in the layout of the pandoc in use'
+        meta, blocks = json.loads(text)
+        return json.dumps({'pandoc-api-version': self.api,
+                           'meta': meta.get('unMeta', {}),
+                           'blocks': blocks})
+
+    @staticmethod
+    def _from_api(text):
+        'return JSON text of the pandoc in use in the old layout'
+        doc = json.loads(text)
+        return json.dumps([{'unMeta': doc['meta']}, doc['blocks']])
+
+    def _run(self, text, to, frm, args, filename=None):
+        'run pandoc in a worker slot, return its output'
+        if not self._ready:
+            self.setup()
+        if self.api is not None:
+            if frm == 'json' and filename is None:
+                text = self._to_api(text)
+            frm, args = self._args(frm, args)
+
+        start = time.perf_counter()
+        with self._slots:
+            started = time.perf_counter()
+            try:
+                rv = self._exec(text, to, frm, args, filename)
+            finally:
+                done = time.perf_counter()
+                with self._lock:
+                    self.calls += 1
+                    self.busy += done - started
+                    self.wait += started - start
+                    self.slowest = max(self.slowest, done - started)
+
+        log.debug('pandoc %s -> %s: %.4fs (waited %.4fs)', frm, to,
+                  done - started, started - start)
+        if to == 'json' and self.api is not None:
+            rv = self._from_api(rv)
+        return rv
+
+    def _exec(self, text, to, frm, args, filename):
+        'convert using the server if possible, a subprocess otherwise'
+        opts = None if self.server is None else self.server.options(args)
+        if opts is not None:
+            if filename is not None:
+                with open(filename, 'rt', encoding='utf8') as fh:
+                    text = fh.read()
+            return self.server.convert(text, to, frm, opts)
+
+        cmd = [self.path, '--from', frm, '--to', to] + list(args or [])
+        if filename is not None:
+            cmd.append(filename)
+            data = None
+        else:
+            data = text.encode('utf8')
+        proc = subprocess.run(cmd, input=data, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise PandocError('pandoc failed ({}): {}'.format(
+                proc.returncode, proc.stderr.decode('utf8', 'replace')))
+        return proc.stdout.decode('utf8')
+
+    def convert_text(self, text, to, frm, args=None):
+        'return text converted from format frm to format to'
+        return self._run(text, to, frm, args)
+
+    def convert_file(self, filename, to, frm, args=None):
+        'return contents of filename converted from format frm to format to'
+        if not os.path.isfile(filename):
+            raise PandocError('no such file {!r}'.format(filename))
+        return self._run(None, to, frm, args, filename=filename)
@@ -1,23 +1,34 @@
 # -*- encoding: utf8 -*-
 import sys
 import os
-import shutil
 import copy
-import time
 import urllib.request
 import json
-import pypandoc as pp
+import re
+import hashlib
+import mmap
+import struct
+import uuid
+import unicodedata
 import pandocfilters as pf
 from collections import namedtuple
 from itertools import chain
 import io
 import logging
 import threading
+import time
+import contextlib
 
 # Mantra imports
 from config import cfg
 from logger import ThreadFilter
+import pdexec
+import jobs
+import events
+import generation
+import imgstore
 import utils
+import watcher
 
 # Globals
 msgfmt = '%(asctime)s [%(threadName)s] %(funcName)s: %(message)s'
@@ -34,6 +45,33 @@ log = logging.getLogger(cfg.app_name)
 log.debug('logging via %s', log.name)
 log.setLevel(logging.DEBUG)
 
+# packed questions of a test, see QuestionPack
+QSTN_PAK = 'qstn.pak'
+
+# metrics of a test's last compile, next to its mtr.idx
+MTR_STATS = utils.TEST_STATS
+
+# stages of a compile and their share (%) of its work, see progress()
+STAGES = [
+    ('parse', 15),       # source -> pandoc AST
+    ('questions', 45),   # AST -> questions, per question
+    ('markdown', 20),    # tags, pruning & batched markdown conversion
+    ('save', 10),        # question pack & stale files
+    ('images', 10),      # image store & index files
+]
+
+# pandoc runs are shared by all compile threads
+PANDOC = pdexec.Executor(cfg.pandoc, cfg.pandoc_workers)
+
+# markdown -> AST conversions by source checksum, pandoc version & format
+AST_CACHE = utils.DiskCache(os.path.join(cfg.cache_dir, 'ast'),
+                            cfg.ast_cache_mb * 1024 * 1024)
+
+# AST fragment -> markdown conversions, optionally persisted to disk
+MD_CACHE = utils.LruCache(cfg.md_cache_size, None if not cfg.md_cache_mb else
+                          utils.DiskCache(os.path.join(cfg.cache_dir, 'md'),
+                                          cfg.md_cache_mb * 1024 * 1024))
+
 # pylint disable: E265
 # - helpers nopep8
 
@@ -44,6 +82,81 @@ log.setLevel(logging.DEBUG)
 # TLS = threading.local()
 
 
+class Metrics(object):
+    '''
+    Counters & timers by name, eg. pandoc runs per call site.
+
+    Each name has a count and the seconds spent, for *.bytes names the count
+    is the number of bytes.  A compile job collects its own metrics (see
+    compile_test), which also add up in the process wide METRICS.
+    '''
+
+    def __init__(self):
+        self.data = {}  # name -> [count, secs]
+        self._lock = threading.Lock()
+
+    def add(self, name, secs=0.0, count=1):
+        'add count and secs to metric name'
+        with self._lock:
+            metric = self.data.setdefault(name, [0, 0.0])
+            metric[0] += count
+            metric[1] += secs
+
+    def summary(self):
+        'return dict name -> {count, secs}'
+        with self._lock:
+            return dict((name, {'count': count, 'secs': round(secs, 6)})
+                        for name, (count, secs) in sorted(self.data.items()))
+
+
+# all compiles of this process
+METRICS = Metrics()
+
+
+def measure(name, secs=0.0, count=1):
+    'add to the metrics of the current compile (if any) and to METRICS'
+    METRICS.add(name, secs, count)
+    metrics = getattr(TLS, 'metrics', None)
+    if metrics is not None:
+        metrics.add(name, secs, count)
+
+
+def progress(stage, n=0, total=0):
+    'publish stage (n of total done) as an event of the current job, if any'
+    job = getattr(TLS, 'job', None)
+    if job is None:
+        return  # eg. bulk compiles
+    pct = 0.0
+    for name, share in STAGES:
+        if name == stage:
+            pct += share * n / total if total else 0.0
+            break
+        pct += share
+    events.BUS.publish(job, 'question' if total else 'stage', stage, n,
+                       total, pct)
+
+
+@contextlib.contextmanager
+def timed(name):
+    'measure the time spent in a with-block as metric name'
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        measure(name, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def pandoc_site(site):
+    'pandoc runs in a with-block are measured as pandoc.<site>'
+    prev = getattr(TLS, 'site', None)
+    TLS.site = site
+    try:
+        yield
+    finally:
+        TLS.site = prev
+
+
 def as_block(key, value):
     'return (key,value)-combination as a block element'
     return {'t': key, 'c': value}
@@ -96,6 +209,7 @@ def ol_num(num, style):
 
 # CLASSES
 Token = namedtuple('Token', ['type', 'value'])
+NULL_ATTR = ['', [], []]  # [id, [classes], [(key, val)]] without any
 
 
 class QError(Exception):
@@ -253,8 +367,19 @@ class PandocAst(object):
     def from_file(cls, filename, fmt=None, opts=None):
         fmt = '+'.join([fmt or cls.FMT] + (opts or cls.MD_OPTS))
         try:
-            txt = pp.convert_file(filename, 'json', format=fmt)
-            meta, ast = json.loads(txt)
+            # - an unchanged source need not be parsed by pandoc again
+            checksum = utils.file_checksum(filename)
+            version = '.'.join(map(str, PANDOC.locate().version))
+            key = AST_CACHE.key(checksum, version, fmt)
+            txt = None if checksum is None else AST_CACHE.get(key)
+            if txt is None:
+                with timed('pandoc.from_file'):
+                    txt = PANDOC.convert_file(filename, 'json', fmt)
+                meta, ast = json.loads(txt)
+                AST_CACHE.put(key, txt)
+            else:
+                log.debug('cached ast for %r', filename)
+                meta, ast = json.loads(txt)
         except Exception as e:
             log.debug('cannot convert file %r\n  ->  (%s)', filename, repr(e))
             raise QError('err converting file {!r}'.format(filename)) from e
@@ -287,8 +412,525 @@ class PandocAst(object):
         'turn pandoc json AST into output format'
         out_fmt = out_fmt or self.FMT
         xtra = xtra or self.MD_XTRA
+        key = self.memo_key(out_fmt, xtra)
+        txt = MD_CACHE.get(key)
+        if txt is None:
+            txt = MD_CACHE.put(key, self._convert(out_fmt, xtra))
+        return txt
+
+    def memo_key(self, out_fmt, xtra):
+        'return key for the conversion of this ast in MD_CACHE'
+        # canonical json, so equal fragments yield equal keys
+        doc = json.dumps([self.meta, self.ast], sort_keys=True,
+                         separators=(',', ':'))
+        version = '.'.join(map(str, PANDOC.locate().version))
+        return MD_CACHE.key(doc, out_fmt, ' '.join(xtra), version)
+
+    def _convert(self, out_fmt, xtra):
+        'run pandoc to turn json AST into output format (uncached)'
         json_str = json.dumps([self.meta, self.ast])
-        return pp.convert_text(json_str, out_fmt, 'json', extra_args=xtra)
+        with timed('pandoc.{}'.format(getattr(TLS, 'site', None) or 'text')):
+            return PANDOC.convert_text(json_str, out_fmt, 'json', xtra)
+
+
+class PandocBatch(object):
+    '''
+    Convert many AST fragments using as few pandoc runs as possible.
+
+    Fragments are joined into a single document, separated by a marker
+    paragraph, converted in one go and split back out again.  Output per
+    fragment is identical to PandocAst(fragment).convert().
+
+    Pandoc's writer carries some state across a document:
+    - header identifiers: a header's id is only written if it differs from
+      the auto-id, which depends on the ids seen before.  Fragments with
+      headers that might collide go into separate lanes (1 run per lane).
+    - footnotes: are collected at the end of a document, so fragments with
+      notes are converted on their own.
+
+    Usage:
+
+    batch = PandocBatch()
+    batch.add(ast1)
+    batch.add(ast2)
+    txt1, txt2 = batch.convert()
+    '''
+
+    def __init__(self, out_fmt=None, xtra=None):
+        self.out_fmt = out_fmt or PandocAst.FMT
+        self.xtra = xtra or PandocAst.MD_XTRA
+        self.asts = []
+
+    def __len__(self):
+        return len(self.asts)
+
+    def add(self, ast):
+        'add an ast fragment, returns its index in the results'
+        # not copied, so ast must not be modified until it is converted
+        self.asts.append(ast)
+        return len(self.asts) - 1
+
+    @staticmethod
+    def _keys(ast):
+        'return set of header keys in ast, None if ast must run on its own'
+        # a header's auto-id only ever differs from its per-fragment value if
+        # an earlier id has the same letters (eg 'foo' vs 'foo-1'), so use
+        # the letters of the header text (or 'section' if none) as key.
+        keys, notes = set(), []
+
+        def action(key, val, fmt, meta):
+            if key == 'Note':
+                notes.append(val)  # notes end up at the end of the doc
+            elif key == 'Header':
+                txt = pf.stringify(val[2]).lower()
+                keys.add(''.join(c for c in txt if c.isalpha()) or 'section')
+
+        pf.walk(ast, action, '', {})
+        return None if len(notes) else keys
+
+    def _lanes(self, idxs):
+        'return list of lanes of ast indices to be converted together'
+        lanes = []  # [(keys, [idx, ..]), ..]
+        for idx in idxs:
+            ast = self.asts[idx]
+            keys = self._keys(ast) if len(ast) else None
+            if keys is None:
+                lanes.append((None, [idx]))  # convert on its own
+                continue
+            for lane_keys, lane in lanes:
+                if lane_keys is not None and lane_keys.isdisjoint(keys):
+                    lane_keys.update(keys)
+                    lane.append(idx)
+                    break
+            else:
+                lanes.append((keys, [idx]))
+        return [lane for _, lane in lanes]
+
+    def convert(self, idxs=None):
+        'convert fragments (default all), returns outputs in order added'
+        # fragments not in idxs (if given) are not converted and yield None
+        idxs = range(len(self.asts)) if idxs is None else sorted(idxs)
+        rv = [None] * len(self.asts)
+
+        # only convert the first of equal fragments not seen before
+        keys, todo, dups = {}, {}, []
+        for idx in idxs:
+            key = PandocAst(self.asts[idx]).memo_key(self.out_fmt, self.xtra)
+            if key in keys:
+                dups.append((idx, key))
+                continue
+            keys[key] = idx
+            rv[idx] = MD_CACHE.get(key)
+            if rv[idx] is None:
+                todo[idx] = key
+
+        lanes = self._lanes(todo)
+        for lane in lanes:
+            if len(lane) == 1:
+                ast = PandocAst(self.asts[lane[0]])
+                rv[lane[0]] = ast._convert(self.out_fmt, self.xtra)
+                continue
+
+            # marker can't be part of the text, since this run made it up
+            marker = 'MANTRA{}BATCH'.format(uuid.uuid4().hex.upper())
+            sep_block = as_block('Para', [as_block('Str', marker)])
+            doc = []
+            for idx in lane:
+                if len(doc):
+                    doc.append(sep_block)
+                doc.extend(self.asts[idx])
+
+            # each fragment converted on its own would end in a single \n,
+            # or be empty (eg an empty Para) and then the marker comes first
+            # - uncached, only its fragments can be converted again
+            txt = PandocAst(doc)._convert(self.out_fmt, self.xtra)
+            parts = re.split('^{}\n\n?'.format(marker), txt, flags=re.M)
+            if len(parts) != len(lane):
+                raise QError('batch conversion lost its separators')
+            for idx, part in zip(lane, parts):
+                rv[idx] = part[:-1] if part.endswith('\n\n') else part
+
+        for idx, key in todo.items():
+            MD_CACHE.put(key, rv[idx])
+        for idx, key in dups:
+            txt = MD_CACHE.get(key)  # counts as a hit
+            rv[idx] = rv[keys[key]] if txt is None else txt
+
+        log.debug('%d fragments, %d new, %d pandoc runs', len(idxs),
+                  len(todo), len(lanes))
+        return rv
+
+
+class MdUnsupported(QError):
+    'raised by MdWriter for anything it cannot write (exactly like pandoc)'
+    pass
+
+
+class MdWriter(object):
+    '''
+    Write pandoc AST fragments as markdown without running pandoc.
+
+    Mimics pandoc's markdown writer (with --atx-header, 72 columns) for the
+    elements questions mostly consist of: Header, Para, Plain, CodeBlock,
+    lists and the Str, Space, Emph, Strong, Code, Link, Image and Math
+    inlines.  Anything else, or anything pandoc might write differently
+    (escapes, list markers at the start of a line, ..), raises MdUnsupported
+    so the caller can fall back to pandoc.
+
+    Bullet list markers, fenced code attributes, list separators, empty
+    documents and the escaping of quotes, dashes and ellipses differ between
+    pandoc versions, so those are learned from the installed pandoc once
+    (calibration).
+
+    Usage:
+
+    try:
+        txt = MdWriter().write(ast)
+    except MdUnsupported:
+        txt = PandocAst(ast).convert('markdown')
+    '''
+    COLUMNS = 72                   # pandoc's default line width
+    STR_CHARS = '.,;:!?%/=()+-'    # besides alnum's, written as is
+    PROBES = ["'", '"', '...', '--']  # written as is or escaped, calibrated
+    STYLES = {
+        'Decimal': str,
+        'LowerAlpha': lambda n: chr(n - 1 + ord('a')),
+        'UpperAlpha': lambda n: chr(n - 1 + ord('A')),
+        'LowerRoman': lambda n: as_roman(n).lower(),
+        'UpperRoman': as_roman,
+    }
+    DELIMS = {'Period': '{}.', 'OneParen': '{})', 'TwoParens': '({})'}
+    # words pandoc might escape at the start of a (wrapped) line
+    LIST_MARKER = re.compile(r'^\(?(\d+|[a-zA-Z]|[ivxlcdmIVXLCDM]+)[.)]$')
+    CODE_CLASS = re.compile(r'^[\w-]+$')
+    _BRK = object()   # breakable space
+    _NL = object()    # forced newline
+    _lock = threading.Lock()
+    _calibrated = None  # {'probes':, 'empty':, 'bullet':, 'list_sep':, ..}
+
+    def __init__(self):
+        self.headers = 0  # pandoc ids depend on earlier headers
+
+    @classmethod
+    def calibrate(cls):
+        'learn version dependent output from pandoc, once'
+        with cls._lock:
+            if cls._calibrated is not None:
+                return cls._calibrated
+            cls._calibrated = {'probes': {}}
+            words = [as_block('Str', 'a{}b'.format(p)) for p in cls.PROBES]
+            for n in range(len(words) - 1, 0, -1):
+                words.insert(n, as_block('Space', None))
+            doc = [
+                as_block('Para', words),
+                as_block('BulletList', [[as_block('Plain', [
+                    as_block('Str', 'x')])]]),
+                as_block('CodeBlock', [['', [], []], 'w']),
+                as_block('CodeBlock', [['', ['c'], []], 'z']),
+            ]
+            try:
+                # uncached, these documents are never converted again
+                lines = PandocAst(doc)._convert(
+                    PandocAst.FMT, PandocAst.MD_XTRA).split('\n')
+                empty = PandocAst([])._convert(PandocAst.FMT,
+                                               PandocAst.MD_XTRA)
+            except Exception as e:
+                log.debug('calibration failed: %s', repr(e))
+                return cls._calibrated
+
+            rv = cls._calibrated
+            rv['empty'] = empty
+            for probe, word in zip(cls.PROBES, lines[0].split(' ')):
+                if word.startswith('a') and word.endswith('b') and \
+                        word[1:-1] in (probe, '\\' + probe):
+                    rv['probes'][probe] = word[1:-1]
+            if len(lines) > 2 and lines[2].endswith('x') and \
+                    lines[2][:-1].strip() == '-':
+                rv['bullet'] = lines[2][:-1]
+            # a list followed by a code block (or list) gets a separator
+            if '    w' in lines and 'z' in lines:
+                sep = lines[3:lines.index('    w')]
+                if len(sep) and sep[0] == sep[-1] == '':
+                    rv['list_sep'] = sep[1:-1]
+                fence = lines.index('z')
+                if lines[fence-1].startswith('```') and \
+                        lines[fence-1].count('c') == 1:
+                    rv['fence'] = (lines[fence-1].replace('c', '{}'),
+                                   lines[fence+1])
+            log.debug('calibrated %r', rv)
+            return rv
+
+    def write(self, ast):
+        'return markdown for a list of blocks, raises MdUnsupported'
+        self.settings = self.calibrate()
+        self.headers = 0
+        if len(ast) == 0:
+            if 'empty' not in self.settings:
+                raise MdUnsupported('empty ast')
+            return self.settings['empty']
+        return '\n'.join(self._blocks(ast, self.COLUMNS)) + '\n'
+
+    # -- blocks
+
+    def _blocks(self, blocks, width):
+        'return lines for a list of blocks, separated by blank lines'
+        lines = []
+        for nr, block in enumerate(blocks):
+            key, val = block['t'], block.get('c')
+            nxt = blocks[nr+1]['t'] if nr + 1 < len(blocks) else None
+            meth = getattr(self, '_{}'.format(key.lower()), None)
+            if meth is None:
+                raise MdUnsupported(key)
+            if key == 'Plain' and nxt is not None:
+                raise MdUnsupported('Plain followed by {}'.format(nxt))
+            if len(lines):
+                lines.append('')
+            lines.extend(meth(val, width))
+
+            # pandoc separates a list from an indented code block or another
+            # list of the same type (so they don't merge)
+            if key in ('BulletList', 'OrderedList') and (nxt == key or (
+                    nxt == 'CodeBlock' and blocks[nr+1]['c'][0] == NULL_ATTR)):
+                if 'list_sep' not in self.settings:
+                    raise MdUnsupported('{} followed by {}'.format(key, nxt))
+                for line in self.settings['list_sep']:
+                    lines.extend(['', line])
+        return lines
+
+    def _para(self, val, width):
+        # Para -> [Inline]
+        if len(val) == 1 and val[0]['t'] == 'Image':
+            raise MdUnsupported('implicit figure')
+        return self._wrap(self._words(self._inlines(val)), width)
+
+    _plain = _para
+
+    def _header(self, val, width):
+        # Header -> [level, [id, [classes], [(key, val)]], [Inline]]
+        level, (ident, classes, kvs), inlines = val
+        self.headers += 1
+        if self.headers > 1 or len(classes) or len(kvs):
+            raise MdUnsupported('header attributes')
+        chunks = self._inlines(inlines)
+        # headers don't wrap, so pandoc writes all spaces as is
+        spaces = [chunk is self._BRK for chunk in chunks]
+        if len(chunks) == 0 or self._NL in chunks or spaces[0] or \
+                spaces[-1] or any(a and b for a, b in zip(spaces, spaces[1:])):
+            raise MdUnsupported('header spacing')
+        words = self._words(chunks)
+        # pandoc only writes the id if it differs from the auto-id
+        attr = ''
+        if ident and ident != self._ident(inlines):
+            if not self.CODE_CLASS.match(ident.replace('.', '')):
+                raise MdUnsupported('header id {!r}'.format(ident))
+            attr = ' {{#{}}}'.format(ident)
+        return ['{} {}{}'.format('#' * level, ' '.join(words), attr)]
+
+    def _codeblock(self, val, width):
+        # CodeBlock -> [[id, [classes], [(key,val)]], code]
+        (ident, classes, kvs), code = val
+        if len(code) == 0 or code.endswith('\n') or '\t' in code:
+            raise MdUnsupported('code block layout')
+        lines = code.split('\n')
+        if [ident, classes, kvs] == NULL_ATTR:
+            return ['    ' + line if line else '' for line in lines]
+
+        fence = self.settings.get('fence', None)
+        if ident or len(kvs) or len(classes) != 1 or fence is None or \
+                '`' in code or not self.CODE_CLASS.match(classes[0]):
+            raise MdUnsupported('code block attributes')
+        return [fence[0].format(classes[0])] + lines + [fence[1]]
+
+    def _bulletlist(self, val, width):
+        # BulletList -> [[Block]]
+        bullet = self.settings.get('bullet', None)
+        if bullet is None:
+            raise MdUnsupported('bullet list')
+        return self._items([bullet] * len(val), val, width)
+
+    def _orderedlist(self, val, width):
+        # OrderedList -> [[start, style, delim], [[Block]]]
+        (start, style, delim), items = val
+        style = self.STYLES.get(style['t'], None)
+        delim = self.DELIMS.get(delim['t'], None)
+        if style is None or delim is None or start + len(items) > 26:
+            raise MdUnsupported('list style')
+        markers = []
+        for num in range(start, start + len(items)):
+            marker = delim.format(style(num))
+            markers.append(marker.ljust(3) + ' ')
+        return self._items(markers, items, width)
+
+    def _items(self, markers, items, width):
+        'return lines for list items, hanging on their markers'
+        # tight lists only have [Plain]-items, loose ones start with Para
+        firsts = set(item[0]['t'] if len(item) else None for item in items)
+        if len(firsts) != 1 or firsts & set([None]) or \
+                not firsts < set(['Plain', 'Para']):
+            raise MdUnsupported('list items')
+        tight = firsts == set(['Plain'])
+
+        lines = []
+        for marker, item in zip(markers, items):
+            if len(lines) and not tight:
+                lines.append('')
+            indent = ' ' * len(marker)
+            for nr, line in enumerate(self._blocks(item, width - len(marker))):
+                prefix = marker if nr == 0 else indent
+                lines.append(prefix + line if line else '')
+        return lines
+
+    # -- inlines
+
+    def _inlines(self, inlines, within=()):
+        'return list of strings, _BRK and _NL for inlines'
+        rv = []
+        prev = None
+        for inline in inlines:
+            key, val = inline['t'], inline.get('c')
+            if key in within or (key in ('Emph', 'Strong') and
+                                 prev in ('Emph', 'Strong')):
+                raise MdUnsupported('nested/adjacent emphasis')
+            prev = key
+            if key == 'Str':
+                rv.append(self._str(val))
+            elif key in ('Space', 'SoftBreak'):
+                rv.append(self._BRK)
+            elif key == 'LineBreak':
+                rv.extend(['\\', self._NL])
+            elif key in ('Emph', 'Strong'):
+                mark = '*' if key == 'Emph' else '**'
+                inner = self._inlines(val, within + (key,))
+                if len(inner) == 0 or not isinstance(inner[0], str) or \
+                        not isinstance(inner[-1], str):
+                    raise MdUnsupported('{} layout'.format(key))
+                rv.extend([mark] + inner + [mark])
+            elif key == 'Code':
+                # Code -> [[id, [classes], [(key,val)]], code]
+                attrs, code = val
+                if attrs != NULL_ATTR or self._unsafe(code, '`'):
+                    raise MdUnsupported('code {!r}'.format(code))
+                rv.append('`{}`'.format(code))
+            elif key == 'Math':
+                # Math -> [{'t': InlineMath|DisplayMath}, tex]
+                kind, tex = val
+                if self._unsafe(tex, '$'):
+                    raise MdUnsupported('math {!r}'.format(tex))
+                mark = '$' if kind['t'] == 'InlineMath' else '$$'
+                rv.append('{}{}{}'.format(mark, tex, mark))
+            elif key in ('Link', 'Image'):
+                rv.extend(self._link(key, val, within))
+            else:
+                raise MdUnsupported(key)
+        return rv
+
+    def _str(self, txt):
+        'return Str as written by pandoc'
+        if len(txt) == 0 or not (txt[0].isalnum() or txt[0] == '(') or \
+                self.LIST_MARKER.match(txt) or '---' in txt or '....' in txt:
+            raise MdUnsupported('str {!r}'.format(txt))
+        probes = self.settings['probes']
+        for c in txt:
+            if c.isalnum() and unicodedata.east_asian_width(c) not in 'WF':
+                continue
+            if c in self.STR_CHARS or c in probes:
+                continue
+            raise MdUnsupported('str {!r}'.format(txt))
+        for probe in self.PROBES:
+            if probe in txt:
+                if probe not in probes:
+                    raise MdUnsupported('str {!r}'.format(txt))
+                txt = txt.replace(probe, probes[probe])
+        return txt
+
+    def _link(self, key, val, within):
+        'return Link or Image as list of strings and _BRK/_NL'
+        # Link -> [[id, [classes], [(key,val)]], [Inline], [url, title]]
+        attrs, inlines, (url, title) = val
+        if attrs != NULL_ATTR or len(url) == 0 or \
+                any(c in url for c in ' ()<>"\\`') or '"' in title or \
+                title.startswith('fig:') or url.startswith('mailto:') or \
+                self._stringify(inlines) == url:
+            raise MdUnsupported('{} {!r}'.format(key, url))
+        inner = self._inlines(inlines, within + (key,))
+        if len(inner) and not (isinstance(inner[0], str) and
+                               isinstance(inner[-1], str)):
+            raise MdUnsupported('{} layout'.format(key))
+        title = ' "{}"'.format(title) if title else ''
+        start = '![' if key == 'Image' else '['
+        return [start] + inner + ['](', url, title, ')']
+
+    @staticmethod
+    def _unsafe(txt, mark):
+        'true if code/math txt needs more than plain marks around it'
+        return len(txt) == 0 or mark in txt or '\n' in txt or \
+            txt != txt.strip()
+
+    def _words(self, chunks):
+        'join chunks into words, _NL stays as is'
+        # like pandoc: leading, trailing and double spaces disappear
+        rv, word = [], ''
+        for chunk in chunks:
+            if chunk is self._BRK or chunk is self._NL:
+                if len(word):
+                    rv.append(word)
+                word = ''
+                if chunk is self._NL:
+                    rv.append(chunk)
+            else:
+                word += chunk
+        if len(word):
+            rv.append(word)
+        if len(rv) == 0 or rv[-1] is self._NL:
+            raise MdUnsupported('empty or trailing linebreak')
+        return rv
+
+    def _wrap(self, words, width):
+        'return lines with words, wrapped at width'
+        lines, line = [], None
+        for word in words:
+            if word is self._NL:
+                lines.append(line)
+                line = None
+            elif line is None:
+                line = word
+            elif len(line) + 1 + len(word) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = '{} {}'.format(line, word)
+        lines.append(line)
+        return lines
+
+    def _stringify(self, inlines):
+        'return plain text of inlines, like pandoc does'
+        rv = []
+        for inline in inlines:
+            key, val = inline['t'], inline.get('c')
+            if key == 'Str':
+                rv.append(val)
+            elif key in ('Space', 'SoftBreak', 'LineBreak'):
+                rv.append(' ')
+            elif key in ('Code', 'Math'):
+                rv.append(val[1])
+            elif key in ('Emph', 'Strong'):
+                rv.append(self._stringify(val))
+            elif key in ('Link', 'Image'):
+                rv.append(self._stringify(val[1]))
+            else:
+                raise MdUnsupported(key)
+        return ''.join(rv)
+
+    def _ident(self, inlines):
+        'return the auto-identifier pandoc would give a header'
+        txt = self._stringify(inlines).lower()
+        if not all(ord(c) < 128 for c in txt):
+            raise MdUnsupported('non-ascii header')
+        txt = ''.join(c for c in txt if c.isalnum() or c in '_-. ')
+        txt = '-'.join(txt.split())
+        while len(txt) and not txt[0].isalpha():
+            txt = txt[1:]
+        return txt or 'section'
 
 
 class Question(object):
@@ -323,6 +965,7 @@ class Question(object):
         # - if using lists of lists -> deepcopy would be required!
         for attr, default in self._ATTR_DEFAULTS.items():
             setattr(self, attr, kwargs.get(attr, copy.copy(default)))
+        self.qid = ''  # stable identity within its test (not saved)
 
     # alternate constructor
     @classmethod
@@ -336,16 +979,25 @@ class Question(object):
 
     # alternate constructor
     @classmethod
-    def read(cls, filename):
-        'Create new Question from file in json format, ignores unknown attrs'
+    def read(cls, filename, nr=0):
+        'Create new Question from a packed file (its nr-th) or a json file'
+        with open(filename, 'rb') as fh:
+            packed = fh.read(len(QuestionPack.MAGIC)) == QuestionPack.MAGIC
+        if packed:
+            with QuestionPack(filename) as pack:
+                return pack[nr]
+        # old layout: q<nr>.json file per question
         with open(filename, 'rt') as fh:
             return cls.load_json(fh.read())
 
+    def attrs(self):
+        'return dict of attributes to be saved'
+        _DEF = self._ATTR_DEFAULTS
+        return dict((attr, getattr(self, attr, _DEF[attr])) for attr in _DEF)
+
     def to_json(self):
         'dump to json string'
-        _DEF = self._ATTR_DEFAULTS
-        attrs = dict((attr, getattr(self, attr, _DEF[attr])) for attr in _DEF)
-        json_str = json.dumps(attrs, indent=3)
+        json_str = json.dumps(self.attrs(), indent=3)
         return json_str
 
     def save(self, filename):
@@ -353,12 +1005,131 @@ class Question(object):
             fh.write(self.to_json())
 
 
+class QuestionPack(object):
+    '''
+    Read-only, memory-mapped view of a test's packed questions.
+
+    Layout of a pack file (little endian):
+    - header: magic, version, 0, number of questions N
+    - N fixed-width entries: qid, offset & length of record, record digest
+    - N records: question attributes as compact json (utf8)
+
+    So pack[n] only reads the n-th entry & record, whatever the size of the
+    test.  A question's (qid, digest) changes only if the question does.
+
+    Usage:
+
+    QuestionPack.write('qstn.pak', questions)  # True if (re)written
+    with QuestionPack('qstn.pak') as pack:
+        q = pack[3]                            # 4th Question
+        for q in pack:                         # all, one at a time
+            print(q.qid, q.title)
+    '''
+    MAGIC = b'MTRQ'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHI')      # magic, version, 0, N
+    ENTRY = struct.Struct('<16sQI8s')     # qid, offset, length, digest
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, _, self.count = self.HEADER.unpack_from(self._mm)
+        except struct.error as e:
+            self.close()
+            raise QError('not a question pack {!r}'.format(filename)) from e
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise QError('unsupported question pack {!r}'.format(filename))
+        self._qids = None  # qid -> nr, built on first use
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, nr):
+        'return (qid, offset, length, digest) of the nr-th question'
+        if nr < 0:
+            nr += self.count
+        if not 0 <= nr < self.count:
+            raise IndexError('question pack index out of range')
+        qid, offset, length, digest = self.ENTRY.unpack_from(
+            self._mm, self.HEADER.size + nr * self.ENTRY.size)
+        return qid.rstrip(b'\0').decode('ascii'), offset, length, digest.hex()
+
+    def __getitem__(self, nr):
+        qid, offset, length, _ = self.entry(nr)
+        q = Question(**json.loads(self._mm[offset:offset+length].decode()))
+        q.qid = qid
+        return q
+
+    def __iter__(self):
+        for nr in range(self.count):
+            yield self[nr]
+
+    def index(self, qid):
+        'return nr of question qid, raises KeyError if not found'
+        if self._qids is None:
+            self._qids = dict((self.entry(nr)[0], nr)
+                              for nr in range(self.count))
+        return self._qids[qid]
+
+    @classmethod
+    def pack(cls, questions):
+        'return questions packed as bytes'
+        records = [json.dumps(q.attrs(), separators=(',', ':')).encode()
+                   for q in questions]
+        offset = cls.HEADER.size + len(records) * cls.ENTRY.size
+        parts = [cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, len(records))]
+        for q, record in zip(questions, records):
+            digest = hashlib.sha1(record).digest()[:8]
+            parts.append(cls.ENTRY.pack(q.qid.encode('ascii'), offset,
+                                        len(record), digest))
+            offset += len(record)
+        return b''.join(parts + records)
+
+    @classmethod
+    def write(cls, filename, questions):
+        'write pack of questions, unless unchanged, returns True if written'
+        data = cls.pack(questions)
+        try:
+            with open(filename, 'rb') as fh:
+                if fh.read() == data:
+                    return False
+        except FileNotFoundError:
+            pass
+        # readers may have the old one mmap'd, so replace rather than rewrite
+        tmp = '{}.tmp'.format(filename)
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, filename)
+        return True
+
+
 class Parser(object):
     'Parse a PandocAst into a list of 0 or more Questions'
     # an Attribute Para starts with one of these:
     ATTR_KEYWORDS = ['tags:', 'answer:', 'explanation:', 'section:']
+    # top-level blocks with a handler, others are part of the question text
+    HANDLERS = {
+        'Header': '_header',
+        'Para': '_para',
+        'OrderedList': '_orderedlist',
+        'CodeBlock': '_codeblock',
+    }
 
-    def __init__(self, idx):
+    def __init__(self, idx, batch=True, native=True):
         self.idx = idx    # src.idx to be compiled
         self.meta = {}    # doc's yaml meta data
         self.tags = []    # document tags (from meta)
@@ -366,34 +1137,124 @@ class Parser(object):
         self.imgs = []    # [(src_img, dst_img), ..] to be copied
         self.intro = ''   # q-zero's text, if any, is intro story
         self.flags = []   # [sS][iI][dD]
+        self.batch = batch  # convert markdown in 1 go after parsing
+        self.writer = MdWriter() if native else None  # markdown w/o pandoc
+        self._native = 0  # nr of fragments written without pandoc
+        self._todo = []   # [(question, idx in batch, setter), ..]
+        self._explain = {}  # id(question) -> token of its latest explanation
+        self._batch = PandocBatch()
+        self._path = []   # [(level, slug), ..] of current header & parents
+        self._qids = {}   # question identities seen -> nr of times
+        self._blocks = []  # all blocks of question being parsed
+        self._ast = []     # question text blocks of question being parsed
+        self._handlers = dict((key, getattr(self, name))
+                              for key, name in self.HANDLERS.items())
 
     def parse(self):
-        doc_ast = PandocAst.from_file(self.idx.src)
-        self._docmeta(doc_ast.meta)            # process meta data
-
-        for level, header in doc_ast.headers:
-            self._ast = []                     # ast for question being parsed
-            self.qstn.append(Question())       # new empty Question
-            ptr = self.qstn[-1]                # shorthand to new Question
-            hdr = PandocAst(header)            # setup for iteration of tokens
-            ptr.markdown = hdr.convert()       # org markdown question text
-
-            # extract parts of header sub-ast
-            for key, val in hdr.tokens:
+        progress('parse')
+        with timed('parse.from_file'):
+            doc_ast = PandocAst.from_file(self.idx.src)
+        with timed('parse.docmeta'):
+            self._docmeta(doc_ast.meta)        # process meta data
+
+        # single pass over the doc's top-level blocks, each header starts a
+        # new question, blocks before the first header are question zero.
+        # - the doc's ast is never modified, nor copied
+        total = sum(1 for block in doc_ast.ast if block['t'] == u'Header')
+        step = max(1, total // 50)  # at most ~50 question events
+        done = 0
+        progress('questions', done, total)
+        with timed('parse.blocks'):
+            self._open()
+            for block in doc_ast.ast:
+                key, val = block['t'], block.get('c', None)
                 if key == u'Header':
-                    self._header(key, val)
-                elif key == u'Para':
-                    self._para(key, val)
-                elif key == u'OrderedList':
-                    self._orderedlist(key, val)
+                    self._close()
+                    self._open(block)
+                    done += 1
+                    if done % step == 0 or done == total:
+                        progress('questions', done, total)
+                self._blocks.append(block)
+                handler = self._handlers.get(key, None)
+                if handler is None:
+                    self._ast.append(block)    # part of the question text
                 else:
-                    self._ast.append(as_block(key, val))
+                    handler(key, val)
+            self._close()
+
+        progress('markdown')
+        with timed('parse.inherit_tags'):
+            self._inherit_tags()  # higher levels inherit lower level tags
+        with timed('parse.prune'):
+            self._prune()         # remove non-questions
+        with timed('parse.convert'), pandoc_site('batch'):
+            self._convert()       # fill in batched markdown, if any
+        return self
 
-            # save remaining parts of sub-ast as actual question text
-            ptr.text = PandocAst(self._ast).convert('markdown')
+    def _open(self, header=None):
+        'start a new question, with its header block (if any)'
+        self._blocks = []                   # org markdown question text
+        self._ast = []                      # actual question text
+        self.qstn.append(Question())
+        self.qstn[-1].qid = self._qid(header)
 
-        self._inherit_tags()  # higher levels inherit lower level tags
-        self._prune()         # remove non-questions
+    def _close(self):
+        'finish the question being parsed'
+        q = self.qstn[-1]
+        self._markdown(q, self._blocks,
+                       lambda txt: setattr(q, 'markdown', txt), 'markdown')
+        self._markdown(q, self._ast,
+                       lambda txt: setattr(q, 'text', txt), 'text')
+
+    def _qid(self, header):
+        'return stable identity for question starting with header (if any)'
+        # - slug of its header plus those of its parent headers, so editing
+        #   or inserting a question does not change the identity of others
+        if header is not None:
+            level, (slug, _, _), _ = header['c']
+            while len(self._path) and self._path[-1][0] >= level:
+                self._path.pop()
+            self._path.append((level, slug))
+        key = '/'.join(slug for _, slug in self._path)
+        seen = self._qids.get(key, 0)  # same headers under same parents
+        self._qids[key] = seen + 1
+        if seen:
+            key = '{}#{}'.format(key, seen)
+        return hashlib.sha1(key.encode('utf8')).hexdigest()[:16]
+
+    def _markdown(self, q, ast, setter, site):
+        'setter(markdown) for ast of question q, either now or batched'
+        # site is the caller's role for the markdown, used in metrics
+        if self.writer is not None:
+            try:
+                setter(self.writer.write(ast))
+                self._native += 1
+                measure('markdown.{}.native'.format(site))
+                return
+            except MdUnsupported as e:
+                log.debug('using pandoc, native writer: %s', e)
+
+        if self.batch:
+            self._todo.append((q, self._batch.add(ast), setter))
+            measure('markdown.{}.batched'.format(site))
+        else:
+            with pandoc_site(site):
+                setter(PandocAst(ast).convert('markdown'))
+            measure('markdown.{}.pandoc'.format(site))
+
+    def _convert(self):
+        'convert batched fragments of remaining questions to markdown'
+        # pruned questions need no markdown
+        keep = set(id(q) for q in self.qstn)
+        todo = [(idx, setter) for q, idx, setter in self._todo
+                if id(q) in keep]
+        log.debug('%d fragments written natively, %d need pandoc',
+                  self._native, len(todo))
+        txts = self._batch.convert(idx for idx, _ in todo)
+        for idx, setter in todo:
+            setter(txts[idx])
+        self._todo = []
+        self._batch = PandocBatch()
         return self
 
     def _docmeta(self, meta):
@@ -416,9 +1277,9 @@ class Parser(object):
         # Header -> [level, [slug, [(key,val),..]], [header-blocks]]
         q = self.qstn[-1]
         q.level = val[0]
-        q.title = PandocAst(as_ast(key, val)).convert('markdown')
-        q.title = q.title.strip()
-        log.debug('[level %d] %s', q.level, q.title)
+        self._markdown(q, as_ast(key, val),
+                       lambda txt: setattr(q, 'title', txt.strip()), 'title')
+        log.debug('[level %d] %s', q.level, pf.stringify(val[2]))
 
     def _para(self, key, val):
         # Para -> [Block], might be an <attribute:>-para
@@ -433,32 +1294,44 @@ class Parser(object):
             q.answer = attrs.get('answer:', [])
             q.tags = attrs.get('tags:', [])
             q.section = attrs.get('section:', '')
-            q.explain = attrs.get('explanation:', '')
+            q.explain = ''
+            # a later attr-para wins, even if an earlier explanation is still
+            # waiting for its (batched) markdown
+            token = self._explain[id(q)] = object()
+            if 'explanation:' in attrs:
+                self._markdown(q, attrs['explanation:'],
+                               lambda txt, token=token: self._explained(
+                                   q, token, txt), 'explanation')
         else:
-            # modify para's img urls & collect [(src,dst)'s] for copying later
-            for k, v in PandocAst(val):
-                # Image -> [attrs, Inlines, target]
-                # - attrs = [ident, [classes], [(key,val)-pairs]]
-                # - Inlines = [Inline-elements]  (of the alt-text)
-                # - target = [url, title]
-                if k == 'Image':
-                    src_path = v[-1][0]  # is url or relative to src_dir
-                    if src_path.startswith('http'):
-                        continue
-                    # it should be a file on disk ...
-                    dst_path = os.path.join(cfg.dst_dir,
-                                            self.idx.test_id,
-                                            src_path)
-                    # '{}/{}'.format(self.idx.dst_dir, src_path)
-                    v[-1][0] = dst_path  # is relative to dst_dir
-                    src_dir = os.path.dirname(self.idx.src)
-                    self.imgs.append(
-                         (os.path.join(src_dir, src_path),
-                          os.path.join(cfg.dst_dir, dst_path))
-                    )
-
+            # point para's img urls to dst & collect [(src,dst)'s] for copying
+            # - images are replaced, since the org para is part of the markdown
+            val = [self._image(x) if x['t'] == 'Image' else x for x in val]
             self._ast.append(as_block(key, val))  # append as normal paragraph
 
+    def _explained(self, q, token, txt):
+        'set explanation of q, unless a later attr-para replaced it'
+        if self._explain.get(id(q), None) is token:
+            q.explain = txt.strip()
+
+    def _image(self, inline):
+        'return image inline with its url pointing to dst_dir'
+        # Image -> [attrs, Inlines, target]
+        # - attrs = [ident, [classes], [(key,val)-pairs]]
+        # - Inlines = [Inline-elements]  (of the alt-text)
+        # - target = [url, title]
+        src_path = inline['c'][-1][0]  # is url or relative to src_dir
+        if src_path.startswith('http'):
+            return inline
+        # it should be a file on disk ...
+        dst_path = os.path.join(cfg.dst_dir, self.idx.test_id, src_path)
+        src_dir = os.path.dirname(self.idx.src)
+        self.imgs.append(
+             (os.path.join(src_dir, src_path),
+              os.path.join(cfg.dst_dir, dst_path))
+        )
+        target = [dst_path] + inline['c'][-1][1:]  # is relative to dst_dir
+        return as_block('Image', inline['c'][:-1] + [target])
+
     def _orderedlist(self, key, val):
         'An OrderedList is a multiple-choice (or multiple-correct) element'
         # OrderedList -> ListAttributes [[Block]]
@@ -473,8 +1346,11 @@ class Parser(object):
             style = style.get('t')
             delim = delim.get('t')
             for n, item in enumerate(items):
-                txt = PandocAst(item).convert('markdown').strip()
-                q.choices.append((ol_num(n+1, style), txt))
+                num = ol_num(n+1, style)
+                q.choices.append((num, ''))  # markdown is set by _markdown
+                self._markdown(q, item, lambda txt, n=n, num=num:
+                               q.choices.__setitem__(n, (num, txt.strip())),
+                               'choice')
             log.debug('choices q[%d] is %r', len(self.qstn), q.choices)
 
     def _para_attr(self, para):
@@ -498,23 +1374,21 @@ class Parser(object):
 
         # collect subast per attribute in ATTR_KEYWORDS
         ptr = attrs.setdefault(attr, [])
-        for key, val in PandocAst(para).tokens:
-            if key != 'Str':
-                ptr.append(as_block(key, val))    # append non-Str to ptr
-                continue
-            attr = val.lower()
-            if attr in self.ATTR_KEYWORDS:
-                ptr = attrs.setdefault(attr, [])  # keyword: starts new ptr
-                continue
-            ptr.append(as_block(key, val))        # otherwise, append to ptr
+        for inline in para:
+            if inline['t'] == 'Str':
+                attr = inline['c'].lower()
+                if attr in self.ATTR_KEYWORDS:
+                    ptr = attrs.setdefault(attr, [])  # keyword: starts new ptr
+                    continue
+            ptr.append(inline)                        # otherwise, append
 
         # process known attributes
         for attr, subast in attrs.items():
             if attr not in self.ATTR_KEYWORDS:
                 continue
             if attr == 'explanation:':
-                xpl = PandocAst(as_ast('Para', subast)).convert('markdown')
-                attrs[attr] = xpl.strip()
+                # markdown text, _para converts its ast
+                attrs[attr] = as_ast('Para', subast)
 
             elif attr == 'tags:':
                 # list of words, possibly separated by spaces and/or comma's
@@ -573,25 +1447,111 @@ class Parser(object):
 
 
 def _copy_files(src_dst):
-    'safely copy src to dst (if src is newer)'
-    for src, dst in src_dst:
-        try:
-            # src available and readable
-            if not os.access(src, os.R_OK):
-                log.error(' - skip missing src %s', src)
-                continue
-
-            dst_dir = os.path.dirname(dst)
-            os.makedirs(dst_dir, exist_ok=True)
-
-            if not os.access(dst, os.F_OK) or\
-                    os.path.getmtime(src) > os.path.getmtime(dst):
-                    shutil.copy2(src, dst)
-                    log.info('- add %s', dst)
-            else:
-                log.info('- keep %s', dst)
-        except OSError:
-            log.exception('copy failed %s -> %s', src, dst)
+    'link dst to the stored copy of its src (stored if needed)'
+    stats = utils.StatCache(imgstore.STORE.workers)
+    try:
+        with timed('images.copy'):
+            placed = imgstore.STORE.place(src_dst, stats)
+        srcs = dict((dst, src) for src, dst in src_dst)
+        for dst, msg in placed:
+            log.info('- %s %s', msg, dst)
+            if msg == 'add':
+                # dst is a link to a copy of src, so it has src's size
+                measure('images.bytes', count=stats.stat(srcs[dst]).st_size)
+    except OSError:
+        log.exception('copy failed for %s', src_dst)
+    log.debug('image stats: %s', stats.counts())
+
+
+def compile_test(idx, dst_dir):
+    'compile source of idx into (generation) dst_dir, returns the Parser used'
+    # collect this compile's metrics, while adding to the process wide ones
+    TLS.metrics = Metrics()
+    try:
+        with timed('compile'):
+            p = _compile_test(idx, dst_dir)
+        _save_stats(idx, dst_dir, TLS.metrics, len(p.qstn))
+    finally:
+        TLS.metrics = None
+    return p
+
+
+def _save_stats(idx, dst_dir, metrics, numq):
+    'save metrics of a compile as json next to its mtr.idx'
+    stats = {
+        'test_id': idx.test_id,
+        'questions': numq,
+        'finished': time.time(),
+        'metrics': metrics.summary(),
+    }
+    fname = os.path.join(dst_dir, MTR_STATS)
+    with open(fname + '.tmp', 'wt') as fh:
+        json.dump(stats, fh, indent=1)
+    os.replace(fname + '.tmp', fname)
+    log.info('Created %s', fname)
+    for name, metric in stats['metrics'].items():
+        log.debug('- %-28s %8d %10.4fs', name, metric['count'],
+                  metric['secs'])
+
+
+def _compile_test(idx, dst_dir):
+    'compile_test, without the metrics'
+    # parse the source file -> p.meta, p.tags, p.qstn
+    p = Parser(idx).parse()
+
+    # dst_dir is not published yet, files written to it must replace any
+    # files it shares (hard links) with the current generation.
+
+    # save to dst_dir, an unchanged pack keeps its file (and mtime)
+    progress('save')
+    log.info('Save questions:')
+    fname = os.path.join(dst_dir, QSTN_PAK)
+    if QuestionPack.write(fname, p.qstn):
+        log.info('- add %s (%d questions)', fname, len(p.qstn))
+
+    # clear output directory (carefully) of files no longer needed
+    # - includes q*.json files of the old layout
+    log.info('Delete stale files:')
+    keep = set(['mtr.log', 'mtr.idx', utils.TEST_IMGS, MTR_STATS, QSTN_PAK])
+    for fname in utils.glob_files(dst_dir,
+                                  includes=['*'],
+                                  excludes=['./mtr.log', '*.png']
+                                  ):
+        if fname not in keep:
+            fname = os.path.join(dst_dir, fname)
+            log.info('- del %s', fname)
+            os.remove(fname)
+
+    progress('images')
+    log.info('Copy images (if needed):')
+    live = os.path.join(cfg.dst_dir, idx.test_id)  # img urls point here
+    _copy_files([(src, os.path.join(dst_dir, os.path.relpath(dst, live)))
+                 for src, dst in p.imgs])
+
+    # create img.idx, so the index can tell when a src.img changes
+    fname = os.path.join(dst_dir, utils.TEST_IMGS)
+    with open(fname + '.tmp', 'wt') as fh:
+        fh.write(json.dumps(p.imgs))
+    os.replace(fname + '.tmp', fname)
+
+    # create mtr.idx
+    idx = idx._replace(flag='P')
+    fname = os.path.join(dst_dir, 'mtr.idx')
+    with open(fname + '.tmp', 'wt') as fh:
+        fh.write(json.dumps(idx))
+    os.replace(fname + '.tmp', fname)
+    log.info('Created %s', fname)
+    for fld in idx._fields:
+        log.info('- %-8s: %s', fld, getattr(idx, fld))
+
+    # create quiz.json
+    log.debug('meta:')
+    for k, v in p.meta.items():
+        log.debug('%-12s: %s', k, v)
+    log.debug('ast cache: %s', AST_CACHE.stats())
+    log.debug('md cache: %s', MD_CACHE.stats())
+    log.debug('img store: %s', imgstore.STORE.stats())
+    return p
 
 
 class Compiler(metaclass=utils.Cached):
@@ -600,37 +1560,94 @@ class Compiler(metaclass=utils.Cached):
     def __init__(self, job):
         self.job = job  # test_id as job_id
         self.msgs = []  # compiler status msgs
-        self.running = False
         self.logfile = ''
+        self.tail = None  # reads the logfile incrementally
+        self.lines = []   # lines of the logfile read so far
+        self._lock = threading.Lock()
 
-    def start(self, nav, cfg):
+    def start(self, nav, cfg, priority=jobs.INTERACTIVE):
         if self.running:
             log.debug('Compiler returning running self %r', self)
             return self
         self.cfg = cfg
         self.nav = nav
-        log.debug('start compile job for %r', nav)
+        log.debug('queue compile job for %r', nav)
         # threadname=job (ie test_id) for ThreadFilter later on
-        threading.Thread(target=self._run, name=self.job).start()
+        jobs.SCHEDULER.submit(('compile', self.job), self._run,
+                              name=self.job, priority=priority)
         return self
 
+    @property
+    def state(self):
+        'queued, running, done, failed or None (never ran or expired)'
+        job = jobs.SCHEDULER.job(('compile', self.job))
+        return None if job is None else job.state
+
+    @property
+    def running(self):
+        'True if compile job is queued or running'
+        return self.state in ('queued', 'running')
+
+    def recent(self, secs):
+        'True if compile job is running or finished less than secs ago'
+        job = jobs.SCHEDULER.job(('compile', self.job))
+        return job is not None and job.recent(secs)
+
+    @property
+    def position(self):
+        'place in the queue, 0 if running (or done)'
+        return jobs.SCHEDULER.position(('compile', self.job))
+
+    def log_lines(self):
+        'return lines logged by the (last) job, reading only the new ones'
+        # shared by all viewers, so the logfile is read just once
+        with self._lock:
+            if self.tail is not None:
+                self.lines.extend(self.tail.read())
+            return list(self.lines)
+
+    def progress(self):
+        'return dict with state, stage & pct of the (last) job, or None'
+        return events.BUS.progress(self.job)
+
+    def events(self, cursor=0, timeout=0):
+        'return (events, cursor, missed) of the (last) job, see events.py'
+        return events.BUS.read(self.job, cursor, timeout)
+
     def _run(self):
-        'run the compile job in a new thread'
-        self.running = True
+        'run the compile job in a scheduler thread, publishing its events'
         log.debug('Start compile job for %s', self.job)
-
+        events.BUS.start(self.job)
+        # warnings & errors of this job become events as well
+        handler = events.EventHandler(self.job, events.BUS)
+        handler.addFilter(ThreadFilter(self.job))
+        log.addHandler(handler)
+        TLS.job = self.job  # for progress()
+        try:
+            self._compile()
+            events.BUS.end(self.job, 'done')
+        except Exception as e:
+            events.BUS.end(self.job, 'failed', str(e))
+            raise  # job state -> failed
+        finally:
+            TLS.job = None
+            log.removeHandler(handler)
+
+    def _compile(self):
+        'compile the job\'s test into a new generation and publish it'
         # pick up job details via test_id in Mantra Index
-        idxs = utils.MantraIdx(self.cfg.src_dir, self.cfg.dst_dir).sync()
-        idx = idxs.test_id(self.job)
+        idx = watcher.snapshot().test_id(self.job)
         if idx is None:
-            log.debug('No idx entry for job %r', self.job)
-            self.running = False
-            return
+            raise QError('No idx entry for job {!r}'.format(self.job))
 
         # add Handler, captures job log msgs to specific logfile
-        dst_dir = os.path.join(self.cfg.dst_dir, idx.test_id)
-        os.makedirs(dst_dir, exist_ok=True)
-        self.logfile = os.path.join(dst_dir, 'mtr.log')  # for this job
+        # compile into a new generation, readers keep using the current one
+        gen = generation.new(self.cfg.dst_dir, idx.test_id)
+        logfile = os.path.join(gen, 'mtr.log')  # for this job
+        with self._lock:
+            self.logfile = logfile
+            self.tail = utils.LogTail(logfile)
+            self.lines = []
         log.debug('logging to %s', self.logfile)
         handler = logging.FileHandler(self.logfile)
         handler.setFormatter(FORMAT)
@@ -638,48 +1655,18 @@ class Compiler(metaclass=utils.Cached):
         log.addHandler(handler)
         log.info('Parsing source: %s', idx.src)
 
-        # clear output directory (carefully)
-        log.info('Delete (most) files:')
-        for fname in utils.glob_files(dst_dir,
-                                      includes=['*'],
-                                      excludes=['./mtr.log', '*.png']
-                                      ):
-            fname = os.path.join(dst_dir, fname)
-            if fname != self.logfile and not fname.endswith('.png'):
-                log.info('- del %s', fname)
-                os.remove(fname)
-
-        # parse the source file -> p.meta, p.tags, p.qstn
-        p = Parser(idx).parse()
-
-        # save to dst_dir
-        log.info('Add new files:')
-        for nr, q in enumerate(p.qstn):
-            qfname = os.path.join(dst_dir, 'q{:03d}.json'.format(nr))
-            q.save(qfname)
-            log.debug('- add %s', qfname)
-        log.info('Copy images (if needed):')
-        _copy_files(p.imgs)  # copy images
-
-        # create mtr.idx
-        idx = idx._replace(flag='P')
-        fname = os.path.join(dst_dir, 'mtr.idx')
-        with open(fname, 'wt') as fh:
-            fh.write(json.dumps(idx))
-            log.info('Created %s', fname)
-            for fld in idx._fields:
-                log.info('- %-8s: %s', fld, getattr(idx, fld))
-
-        # create quiz.json
-        log.debug('meta:')
-        for k, v in p.meta.items():
-            log.debug('%-12s: %s', k, v)
-        log.info('All done!')
-        # give UI some time to display logfile contents & remove handler
-        log.info('Going to sleep')
-        time.sleep(4)
-        log.info('Dying now')
-        log.removeHandler(handler)
+        try:
+            compile_test(idx, gen)
+            generation.publish(self.cfg.dst_dir, idx.test_id, gen)
+            watcher.refresh(dsts=[idx.test_id])
+            log.info('All done!')
+        except Exception as e:
+            log.exception('Compile failed: %r', e)
+            raise  # job state -> failed
+        finally:
+            # UI picks up the rest of the logfile once it sees job's state
+            log.removeHandler(handler)
+            handler.close()
 
 
 class Quiz(object):
@@ -12,20 +12,27 @@ import hashlib
 import time
 import json
 import fnmatch
-from collections import namedtuple
-from functools import wraps
+import sqlite3
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, lru_cache
 from inspect import ismethod, isfunction
 import logging
 
+import idxdb
+
 # TODO: make utils independent of cfg or Mantra in general
 # - cannot import utils in tests without import the whole app
 # App imports
 # from config import cfg
 
 # -- Globals
-APP_NAME = 'Mantra'      # sameas cfg.app_name
-MSTR_IDX = 'mantra.idx'  # in cfg.dst_dir topdir
-TEST_IDX = 'mtr.idx'     # in cfg.dst_dir subdir's (per test)
+APP_NAME = 'Mantra'        # sameas cfg.app_name
+MSTR_IDX = 'mantra.db'     # next to cfg.dst_dir, ie in cfg.mtr_dir
+TEST_IDX = 'mtr.idx'       # in cfg.dst_dir subdir's (per test)
+TEST_STATS = 'mtr.stats'   # idem, metrics of its last compile
+TEST_IMGS = 'img.idx'      # idem, its images [(src.img, dst.img), ..]
 
 log = logging.getLogger('Mantra')  # hard coded: avoid import config
 log.debug('logging via %s', log.name)
@@ -194,31 +201,45 @@ def set_controls(layout, controls):
 # -- HASH ops
 
 
-def hashfnv64(text, salt=''):
-    'fnv64 hash of text'
-    salt = salt or 'mantra'
-    data = salt.encode('ascii') + text.encode('ascii')
-    hash_n = 0xcbf29ce484222325
+FNV64_OFFSET = 0xcbf29ce484222325
+FNV64_PRIME = 0x100000001b3
+FNV64_MASK = 0xffffffffffffffff
+
+
+def _fnv64(data, hash_n=FNV64_OFFSET):
+    'fnv64 of bytes data, continuing from hash_n'
+    # note: multiply, then xor -- unlike fnv-1a, but existing ids use it
     for b in data:
-        hash_n *= 0x100000001b3
-        hash_n &= 0xffffffffffffffff
-        hash_n ^= b
+        hash_n = (hash_n * FNV64_PRIME & FNV64_MASK) ^ b
+    return hash_n
+
+
+@lru_cache(maxsize=4096)
+def _fnv64_prefix(category):
+    'fnv64 state after hashing category, shared by all its tests'
+    return _fnv64(category.encode('utf8', 'surrogateescape'))
+
+
+@lru_cache(maxsize=1 << 17)
+def hash_test_id(category, basename):
+    'fnv64 hash of category and basename of a src file, as a test_id'
+    # utf8 is ascii for ascii names, so their (existing) ids don't change
+    data = basename.encode('utf8', 'surrogateescape')
+    hash_n = _fnv64(data, _fnv64_prefix(category))
     hash_b = struct.pack('<Q', hash_n)
     return base64.urlsafe_b64encode(hash_b)[:-1].decode('ascii')
 
 
+def hashfnv64(text, salt=''):
+    'fnv64 hash of text'
+    return hash_test_id(salt or 'mantra', text)
+
+
 def get_test_id(topdir, filename):
     'fnv64 hash of basename and category of a src filename'
     basename = os.path.basename(filename)
     category = os.path.relpath(os.path.dirname(filename), topdir)
-    data = category.encode('ascii') + basename.encode('ascii')
-    hash_n = 0xcbf29ce484222325
-    for b in data:
-        hash_n *= 0x100000001b3
-        hash_n &= 0xffffffffffffffff
-        hash_n ^= b
-    hash_b = struct.pack('<Q', hash_n)
-    return base64.urlsafe_b64encode(hash_b)[:-1].decode('ascii')
+    return hash_test_id(category, basename)
 
 
 def file_ctime(filename):
@@ -241,51 +262,466 @@ def file_checksum(filename, block_size=65536):
         return None
 
 
-# -- FILE operations
+class DiskCache(object):
+    '''
+    Size-bounded, on-disk LRU cache of text values by key.
 
-def rgx_files(topdir, include=None, exclude=None):
-    'yield rgx included & not rgx excluded filepaths relative to topdir'
-    include = [re.compile('.*')] if include is None else include
-    exclude = [] if exclude is None else exclude
-
-    for dirname, _, fnames in os.walk(topdir):
-        reldir = os.path.relpath(dirname, topdir)
-        for fname in fnames:
-            relpath = os.path.join(reldir, fname)
-            if not any(rgx.match(relpath) for rgx in include):
+    Entries are files <cache_dir>/<key[:2]>/<key>, least recently used ones
+    are deleted once all entries take up more than max_bytes.
+
+    Usage:
+
+    cache = DiskCache('/path/to/cache', 64*1024*1024)
+    key = cache.key(checksum, version)     # sha256 of all parts
+    txt = cache.get(key)                   # None if not cached
+    cache.put(key, 'some text')
+    '''
+
+    def __init__(self, cache_dir, max_bytes=64*1024*1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._lru = None   # OrderedDict key -> size, oldest first
+        self._size = 0     # total size of entries
+
+    @staticmethod
+    def key(*parts):
+        'return cache key for parts (str or bytes)'
+        sha256 = hashlib.sha256()
+        for part in parts:
+            part = part if isinstance(part, bytes) else str(part).encode()
+            sha256.update(part)
+            sha256.update(b'\0')
+        return sha256.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _load(self):
+        'build the LRU from entries on disk, oldest (mtime) first'
+        # called with lock held
+        if self._lru is not None:
+            return
+        entries = []
+        for frel in rgx_files(self.cache_dir, [re.compile(r'.*/[0-9a-f]+$')]):
+            try:
+                st = os.stat(os.path.join(self.cache_dir, frel))
+            except OSError:
                 continue
-            if any(rgx.match(relpath) for rgx in exclude):
+            entries.append((st.st_mtime, os.path.basename(frel), st.st_size))
+        self._lru = OrderedDict((k, size) for _, k, size in sorted(entries))
+        self._size = sum(self._lru.values())
+
+    def get(self, key):
+        'return cached text for key or None'
+        fname = self._path(key)
+        try:
+            with open(fname, 'rt', encoding='utf8') as fh:
+                txt = fh.read()
+            os.utime(fname)  # mark as recently used, for other processes
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._load()
+            if key in self._lru:
+                self._lru.move_to_end(key)
+            else:
+                self._lru[key] = len(txt)
+                self._size += len(txt)
+        return txt
+
+    def put(self, key, txt):
+        'store txt under key, evicting least recently used entries'
+        fname = self._path(key)
+        tmp = '{}.{}.tmp'.format(fname, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with open(tmp, 'wt', encoding='utf8') as fh:
+                fh.write(txt)
+            os.replace(tmp, fname)
+            size = os.path.getsize(fname)
+        except OSError:
+            log.exception('cannot cache %s', fname)
+            return self
+
+        with self._lock:
+            self._load()
+            self._size += size - self._lru.pop(key, 0)
+            self._lru[key] = size
+            while self._size > self.max_bytes and len(self._lru) > 1:
+                old, old_size = self._lru.popitem(last=False)
+                self._size -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(self._path(old))
+                except OSError:
+                    pass  # another process got there first
+        return self
+
+    def stats(self):
+        'return dict with cache statistics'
+        with self._lock:
+            self._load()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._lru),
+                'bytes': self._size,
+            }
+
+
+class LruCache(object):
+    '''
+    Bounded, in-memory LRU cache, safe to share between threads.
+
+    If given a DiskCache as store, values (text) are also written to disk
+    and looked up there when not in memory, so they survive a restart.
+
+    Usage:
+
+    cache = LruCache(1024)
+    key = cache.key('some', 'parts')       # sha256 of all parts
+    txt = cache.get(key)                   # None if not cached
+    cache.put(key, 'some text')
+    '''
+    key = staticmethod(DiskCache.key)
+
+    def __init__(self, maxsize=1024, store=None):
+        self.maxsize = maxsize
+        self.store = store   # optional DiskCache as second level
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0   # misses in memory, found in store
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()
+
+    def get(self, key):
+        'return cached value for key or None'
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return self._lru[key]
+
+        val = None if self.store is None else self.store.get(key)
+        with self._lock:
+            if val is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._add(key, val)
+        return val
+
+    def put(self, key, val):
+        'cache val under key, returns val'
+        with self._lock:
+            self._add(key, val)
+        if self.store is not None:
+            self.store.put(key, val)
+        return val
+
+    def _add(self, key, val):
+        # called with lock held
+        self._lru[key] = val
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    def stats(self):
+        'return dict with cache statistics'
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups
+                if lookups else 0.0,
+                'entries': len(self._lru),
+                'maxsize': self.maxsize,
+            }
+
+
+# -- FILE operations
+
+class LogTail(object):
+    '''
+    Incremental reader of a growing (log) file.
+
+    Remembers the byte offset it read up to, so each read() returns only
+    the complete lines added since the previous one.  A file that was
+    replaced or truncated is read again from its start.
+    '''
+
+    def __init__(self, fname, offset=0):
+        self.fname = fname
+        self.offset = offset  # of the first byte not yet read
+        self._ino = None
+        self._partial = b''   # an incomplete last line, read already
+        self._lock = threading.Lock()
+
+    @property
+    def position(self):
+        'offset just past the last complete line returned'
+        return self.offset - len(self._partial)
+
+    def read(self):
+        'return list of lines added since the last read, [] if none'
+        with self._lock:
+            try:
+                fh = open(self.fname, 'rb')
+            except OSError:
+                return []
+            with fh:
+                st = os.fstat(fh.fileno())
+                if (self._ino is not None and st.st_ino != self._ino) or \
+                        st.st_size < self.offset:
+                    self.offset, self._partial = 0, b''  # start over
+                self._ino = st.st_ino
+                if st.st_size == self.offset:
+                    return []
+                fh.seek(self.offset)
+                data = fh.read(st.st_size - self.offset)
+            self.offset += len(data)
+            lines = (self._partial + data).split(b'\n')
+            self._partial = lines.pop()
+            return [line.decode('utf8', 'replace') for line in lines]
+
+
+def _glob_prefix(pattern):
+    'return single char regexes of pattern upto its first *, and the rest'
+    tokens, i, n = [], 0, len(pattern)
+    while i < n and pattern[i] != '*':
+        j = i + 1
+        if pattern[i] == '[':
+            # like fnmatch: a ] right after [ or [! is part of the set
+            k = j + 1 if j < n and pattern[j] == '!' else j
+            k = k + 1 if k < n and pattern[k] == ']' else k
+            k = pattern.find(']', k)
+            j = j if k < 0 else k + 1  # unclosed [ is a literal
+        tokens.append(re.compile(fnmatch.translate(pattern[i:j])))
+        i = j
+    return tokens, pattern[i:]
+
+
+class PathMatcher(object):
+    '''
+    Include & exclude patterns, combined into a single regex.
+
+    A relpath matches if any include matches and no exclude does.  Given
+    globs (rather than regexes), prune() tells which dirs cannot hold any
+    matching file, so a walk can skip their entire subtree.  Note: like
+    fnmatch, a * in a glob also matches /'s.
+    '''
+
+    def __init__(self, include=None, exclude=None, globs=True):
+        'include/exclude are lists of globs, or compiled regexes'
+        include = (['*'] if globs else [re.compile('.*')]) \
+            if include is None else include
+        exclude = [] if exclude is None else exclude
+        if globs:
+            self.prefixes = [_glob_prefix(p) for p in include]
+            self.pruners = [(t, r) for t, r in map(_glob_prefix, exclude)
+                            if r and not r.strip('*')]
+            include = [re.compile(fnmatch.translate(p)) for p in include]
+            exclude = [re.compile(fnmatch.translate(p)) for p in exclude]
+        else:
+            self.prefixes, self.pruners = None, []
+
+        flags = set(r.flags for r in include + exclude)
+        if len(flags) == 1:
+            rgx = '(?:{})'.format('|'.join(r.pattern for r in include))
+            if exclude:
+                rgx = '(?!{}){}'.format('|'.join(r.pattern for r in exclude),
+                                        rgx)
+            self.match = re.compile(rgx, flags.pop()).match
+        else:
+            # cannot combine regexes with different flags
+            self.match = lambda relpath: (
+                any(r.match(relpath) for r in include) and
+                not any(r.match(relpath) for r in exclude))
+
+    @staticmethod
+    def _prefixed(tokens, path):
+        return all(tok.match(c) for tok, c in zip(tokens, path))
+
+    def prune(self, reldir):
+        'return True if no file below reldir can match'
+        path = reldir + '/'
+        for tokens, rest in self.pruners:
+            # an exclude like 'dir/*' rejects everything below dir
+            if len(path) >= len(tokens) and self._prefixed(tokens, path):
+                return True
+        if self.prefixes is None:
+            return False  # regexes can't tell
+        for tokens, rest in self.prefixes:
+            # files below have path as prefix, so they are longer than it
+            if (rest or len(path) < len(tokens)) and \
+                    self._prefixed(tokens, path):
+                return False
+        return True
+
+
+def walk_files(topdir, matcher, followlinks=False):
+    'yield (relpath, DirEntry) for files below topdir that match'
+    # relpaths like os.walk + os.path.relpath: './fname' and 'dir/fname'
+    todo = [('', topdir)]
+    while todo:
+        reldir, path = todo.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue  # like os.walk, silently skip unreadable dirs
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not followlinks and entry.is_symlink():
+                    continue
+                subdir = reldir + entry.name
+                if not matcher.prune(subdir):
+                    todo.append((subdir + '/', entry.path))
                 continue
-            yield relpath
+            relpath = (reldir or './') + entry.name
+            if matcher.match(relpath):
+                yield relpath, entry
+
+
+def rgx_files(topdir, include=None, exclude=None, followlinks=False):
+    'yield rgx included & not rgx excluded filepaths relative to topdir'
+    matcher = PathMatcher(include, exclude, globs=False)
+    for relpath, _ in walk_files(topdir, matcher, followlinks):
+        yield relpath
 
 
-def glob_files(topdir, includes=None, excludes=None):
+def glob_files(topdir, includes=None, excludes=None, followlinks=False):
     'list glob included & then not excluded filepaths relative to topdir'
-    includes = ['*'] if includes is None else includes
-    excludes = [] if excludes is None else excludes
-
-    accept = [re.compile(fnmatch.translate(p)) for p in includes]
-    ignore = [re.compile(fnmatch.translate(p)) for p in excludes]
-
-    for dirname, subdirs, files in os.walk(topdir):
-        reldir = os.path.relpath(dirname, topdir)
-        for fname in files:
-            # no normpath just yet to allow globs like '[!.]*/mtr.idx'
-            relpath = os.path.join(reldir, fname)
-            if not any(r.match(relpath) for r in accept):
-                continue
-            if any(r.match(relpath) for r in ignore):
-                continue
-            # loose any ./ or //'s .. etc
-            yield os.path.normpath(relpath)
+    # no normpath just yet to allow globs like '[!.]*/mtr.idx'
+    matcher = PathMatcher(includes, excludes)
+    for relpath, _ in walk_files(topdir, matcher, followlinks):
+        # loose any ./ or //'s .. etc
+        yield os.path.normpath(relpath)
+
+
+class StatCache(object):
+    '''
+    Stats of paths and data loaded from files, by path.
+
+    Stats are remembered for one pass (see begin()), so a file used by many
+    tests is stat'ed only once per pass, and stat_many() runs the stats
+    concurrently on a pool of threads (helps a lot on network filesystems).
+    Data loaded from a file (eg. a parsed img.idx) is kept until the file's
+    (mtime, size, inode) changes.
+
+    Usage:
+
+    stats = StatCache()
+    stats.begin()                    # stats of an earlier pass are stale
+    stats.stat_many(paths)           # -> {path: stat_result or None}
+    stats.load(path, loader)         # loader(path), if path changed
+    '''
+    RACY = 2  # secs, data of a file modified this recently isn't cached
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self._stats = {}   # path -> stat_result or None, for this pass
+        self._data = {}    # path -> ((mtime_ns, size, ino), data)
+        self._lock = threading.Lock()
+        self.calls = 0     # nr of actual stat calls
+        self.hits = 0      # nr of stats answered from this pass
+        self.loads = 0     # nr of files (re)loaded
+
+    def begin(self):
+        'start a new pass, forgetting the stats of the previous one'
+        with self._lock:
+            self._stats = {}
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        with self._lock:
+            self.calls += 1
+            self._stats[path] = st
+        return st
+
+    def stat(self, path):
+        'return stat_result for path, None if it does not exist'
+        with self._lock:
+            if path in self._stats:
+                self.hits += 1
+                return self._stats[path]
+        return self._stat(path)
+
+    def stat_many(self, paths):
+        'return dict of path -> stat_result or None, stats run concurrently'
+        paths = set(paths)
+        with self._lock:
+            todo = [p for p in paths if p not in self._stats]
+            self.hits += len(paths) - len(todo)
+        if len(todo) < 2 or self.workers < 2:
+            for path in todo:
+                self._stat(path)
+        else:
+            with ThreadPoolExecutor(min(self.workers, len(todo))) as pool:
+                list(pool.map(self._stat, todo))
+        with self._lock:
+            return dict((p, self._stats[p]) for p in paths)
+
+    def load(self, path, loader, default=None):
+        'return loader(path), or default if path does not exist'
+        st = self.stat(path)
+        if st is None:
+            with self._lock:
+                self._data.pop(path, None)
+            return default
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            cached = self._data.get(path, None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        data = loader(path)
+        with self._lock:
+            self.loads += 1
+            if st.st_mtime_ns < (time.time() - self.RACY) * 1e9:
+                self._data[path] = (key, data)
+        return data
+
+    def counts(self):
+        'return dict with the number of stats, cached stats & loads'
+        with self._lock:
+            return {'stats': self.calls, 'cached': self.hits,
+                    'loads': self.loads}
 
 
 class MantraIdx:
-    'the index of tests based on src.md and its mtr.idx, img.idx files'
+    '''
+    The index of tests based on src.md and its mtr.idx, img.idx files.
+
+    The index is kept in mantra.db next to dst_dir (see idxdb.py), along with
+    the mtimes of the directories & files it was built from.  A sync only
+    re-lists dirs whose mtime changed and re-stats the sources of the other
+    dirs (concurrently, see StatCache), since editing a source in place does
+    not change its directory's mtime.  A full sync also re-lists all dirs
+    and re-reads all outputs.
+    '''
     # no need for dst include/exclude since those names are fixed
     # donot include any files in src_dir (topdir)
     INCLUDE = ['[!.]**/*.md', '[!.]**/*.markdown', '[!.]**/*.pd']
     EXCLUDE = ['**/notes.*', '**/index.*']
+    VERSION = 5  # of mantra.db's state (5: dsts have their src.imgs)
+    RACY = 2     # secs, an mtime this recent might still change unnoticed
 
     def __init__(self, src_dir, dst_dir, sync=True):
         'if sync is False, manual <instance>.sync() required'
@@ -296,10 +732,24 @@ class MantraIdx:
 
         self.src_dir = src_dir
         self.dst_dir = dst_dir
-        self.set_filter()
         self.idx = {}
+        self.dirs = {}      # src reldir -> [mtime_ns, [subdirs], [srcs]]
+        self.srcs = {}      # src relpath -> [mtime_ns, test_id]
+        # test_id -> [link, mtime_ns, mtr.idx, imgs newer, compile stats,
+        #             [src.img, ..]]
+        self.dsts = {}
+        self.dst_mtime = 0  # mtime_ns of dst_dir itself
+        self.ids = {}       # test_id -> src relpath
+        self.touched = set()  # test_ids whose idx entry must be rebuilt
+        self.rebuild = True   # all idx entries must be rebuilt
+        self.changed = False  # state differs from mantra.db on disk
+        self.dirty = set()    # (kind, key)'s to write on the next save
+        self.resave = True    # mantra.db must be written afresh
+        self.db = idxdb.IdxDB(self._fname(MSTR_IDX))
+        self.stats = StatCache()
+        self.set_filter()
         if sync:
-            self.sync()
+            self.read().sync()
 
     def __iter__(self):
         for k in self.idx:
@@ -308,40 +758,116 @@ class MantraIdx:
     def test_id(self, test_id):
         return self.idx.get(test_id, None)
 
-    def sync(self):
-        'sync index to files present on disk'
-        self.idx.clear()
-        return self._add_srcs()._add_dsts()
+    def sync(self, full=False):
+        'sync index to files present on disk, saves it if anything changed'
+        self.stats.begin()
+        self._sync_dsts(full)._sync_srcs(full)._sync_imgs()
+        log.debug('index sync, %s', self.stats.counts())
+        if self.changed or self.rebuild or full:
+            self._build()
+            self.save()
+        return self
 
-    def save(self, outname='mantra.idx'):
-        'save index to dst_dir/mantra.idx'
-        fname = os.path.join(self.dst_dir, outname)
+    def refresh(self, dirs=(), files=(), dsts=()):
+        'sync only the given src dirs, src files & dsts, returns test_ids'
+        # for callers that know what changed, see watcher.py
+        self.stats.begin()
+        if dsts:
+            self._sync_dsts(names=dsts)
+        for relpath in files:
+            self._stat_src(relpath)
+        if dirs:
+            self._sync_srcs(tops=dirs)
+        self._sync_imgs(self._img_users(dirs, files))
+        touched = set(self.touched)
+        if self.changed or self.rebuild:
+            self._build()
+            self.save()
+        return touched
+
+    def _fname(self, name):
+        'return path for name next to dst_dir'
+        # not in dst_dir, since saving would change dst_dir's mtime
+        return os.path.join(os.path.dirname(os.path.normpath(self.dst_dir)),
+                            name)
+
+    def _row(self, test_id):
+        'return mantra.db row for test_id, None if it is not in the index'
+        entry = self.idx.get(test_id, None)
+        if entry is None:
+            return None
+        frel = self.ids.get(test_id, None)
+        src_mtime = None if frel is None else self.srcs[frel][0]
+        dst = self.dsts.get(test_id, None)
+        dst_mtime = None if dst is None else dst[1]
+        stats = (dst[4] if dst else None) or [None, None, None]
+        return idxdb.IdxRow(test_id, entry.flag, entry.src, entry.category,
+                            src_mtime, dst_mtime, *stats, score=None)
+
+    def save(self):
+        'save changes to the index in mantra.db'
+        if self.resave:
+            self.dirty = set(('tests', k) for k in self.idx)
+            for kind in ('dirs', 'srcs', 'dsts'):
+                self.dirty.update((kind, k) for k in getattr(self, kind))
+        changes, tests = [], []
+        for kind, key in self.dirty:
+            if kind == 'tests':
+                tests.append((key, self._row(key)))
+            else:
+                changes.append((kind, key, getattr(self, kind).get(key)))
+        meta = {
+            'version': self.VERSION,
+            'filter': self.filter,
+            'dst_mtime': self.dst_mtime,
+        }
         try:
-            with open(fname, 'wt') as fh:
-                fh.write(json.dumps(self.idx))
-        except OSError:
-            log.error('could not save mantra.idx')
+            self.db.save(meta, changes, tests, clear=self.resave)
+            self.dirty = set()
+            self.resave = False
+            self.changed = False
+        except sqlite3.Error as e:
+            log.error('could not save %s: %s', self.db.fname, e)
 
         return self
 
-    def read(self, inpname='mantra.idx'):
-        'read index from dst_dir/mantra.idx'
-        fname = os.path.join(self.dst_dir, inpname)
+    def read(self):
+        'read index from mantra.db'
         try:
-            with open(fname, 'rt') as fh:
-                self.idx = json.loads(fh.read())
-        except OSError:
-            log.error('could not read %s' % fname)
-
+            state = self.db.load()
+        except sqlite3.Error as e:
+            log.error('could not read %s: %s', self.db.fname, e)
+            return self
+
+        meta = state['meta']
+        if meta.get('version', None) != self.VERSION:
+            log.debug('no (usable) %s yet', self.db.fname)
+            return self  # sync starts afresh
+        self.idx = dict((k, MtrIdx(row.flag, row.src, row.category, k))
+                        for k, row in state['tests'].items())
+        self.dsts = state['dsts']
+        self.dst_mtime = meta['dst_mtime']
+        if meta['filter'] == self.filter:
+            self.dirs = state['dirs']
+            self.srcs = state['srcs']
+            self.ids = dict((v[1], k) for k, v in self.srcs.items())
+            self.rebuild = False
+            self.changed = False
+            self.resave = False
+            self.dirty = set()
         return self
 
     def set_filter(self, include=None, exclude=None):
         'set include/exclude globs for src files (None means use default)'
         include = self.INCLUDE if include is None else include
         exclude = self.EXCLUDE if exclude is None else exclude
-        self.include = [re.compile(fnmatch.translate(p)) for p in include]
-        self.exclude = [re.compile(fnmatch.translate(p)) for p in exclude]
-        self.dst_mtr = [re.compile(fnmatch.translate('[!.]**/mtr.idx'))]
+        self.matcher = PathMatcher(include, exclude)
+        self.filter = [include, exclude]
+        # other filters, other sources: all dirs must be listed again
+        self.dirs, self.srcs, self.ids = {}, {}, {}
+        self.rebuild = True
+        self.changed = True
+        self.resave = True
         return self
 
     def _read_img_idx(self, fname):
@@ -367,48 +893,278 @@ class MantraIdx:
             log.error('json decode error %r' % fname)
         return None
 
-    def _add_srcs(self):
-        'add idx entries based on sources'
-        for frel in rgx_files(self.src_dir, self.include, self.exclude):
-            src = os.path.join(self.src_dir, frel)
-            cat = os.path.dirname(frel)
-            test_id = hashfnv64(os.path.basename(frel), cat)
-            dst = os.path.join(self.dst_dir, test_id, 'mtr.idx')
-            dst_mtime = os.path.getmtime(dst) if os.path.isfile(dst) else 0
-            src_mtime = os.path.getmtime(src)  # should exist.
-            # flags: C(reate) dst, U(pdate) dst, P(lay) dst
-            flag = 'U' if src_mtime > dst_mtime else 'P'
-            flag = 'C' if dst_mtime == 0 else flag  # special case 'updatable'
-            self.idx[test_id] = MtrIdx(flag, src, cat, test_id)
+    def _mtime(self, st):
+        'return st\'s mtime_ns to remember, -1 if it is too recent to trust'
+        # a change within the same clock tick as this stat goes unnoticed
+        if st.st_mtime_ns > (time.time() - self.RACY) * 1e9:
+            return -1
+        return st.st_mtime_ns
+
+    def _imgs_newer(self, imgs, mtime):
+        'return True if at least 1 src.img is newer than mtime (ns)'
+        # dst.imgs are links into the image store, their mtimes tell nothing
+        # about the compile, so compare with the test's mtr.idx instead
+        stats = self.stats.stat_many(imgs)
+        return any(st is not None and st.st_mtime_ns > mtime
+                   for st in stats.values())
+
+    def _sync_imgs(self, names=None):
+        'update the imgs newer flag of dsts names (default all of them)'
+        names = [n for n in (self.dsts if names is None else names)
+                 if n in self.dsts and self.dsts[n][5]]
+        # stat all src.imgs in one go, many tests share them
+        self.stats.stat_many(img for n in names for img in self.dsts[n][5])
+        for name in names:
+            old = self.dsts[name]
+            newer = self._imgs_newer(old[5], old[1])
+            if newer != old[3]:
+                self.dsts[name] = old[:3] + [newer] + old[4:]
+                self.touched.add(name)
+                self.dirty.add(('dsts', name))
+                self.changed = True
+        return self
 
+    def _img_users(self, dirs=(), files=()):
+        'return test_ids using src.imgs in src reldirs or src relpaths'
+        paths = set(os.path.join(self.src_dir, f) for f in files)
+        dirs = set(os.path.normpath(os.path.join(self.src_dir, d))
+                   for d in dirs)
+        if not (paths or dirs):
+            return []
+        return [name for name, dst in self.dsts.items()
+                if any(img in paths or os.path.dirname(img) in dirs
+                       for img in dst[5])]
+
+    def _set_src(self, relpath, value):
+        'set srcs entry for relpath to [mtime_ns, test_id]'
+        if self.srcs.get(relpath, None) == value:
+            return
+        self.srcs[relpath] = value
+        self.ids[value[1]] = relpath
+        self.touched.add(value[1])
+        self.dirty.add(('srcs', relpath))
+        self.changed = True
+
+    def _pop_src(self, relpath):
+        'remove srcs entry for relpath, if any'
+        old = self.srcs.pop(relpath, None)
+        if old is None:
+            return
+        if self.ids.get(old[1], None) == relpath:
+            del self.ids[old[1]]
+        self.touched.add(old[1])
+        self.dirty.add(('srcs', relpath))
+        self.changed = True
+
+    def _stat_src(self, relpath):
+        'update mtime of a known source (eg. edited in place)'
+        old = self.srcs.get(relpath, None)
+        if old is None:
+            return  # new sources show up via their directory
+        try:
+            mtime = os.stat(os.path.join(self.src_dir, relpath)).st_mtime_ns
+        except OSError:
+            return  # removed, its directory's listing will drop it
+        self._set_src(relpath, [mtime, old[1]])
+
+    def _sync_srcs(self, full=False, tops=None):
+        'update srcs, listing only src dirs that changed (or tops)'
+        # tops: reldirs to list regardless of their mtime, and the only
+        # subtrees to visit.  Default is all of src_dir.
+        force = set() if tops is None else set(tops)
+        todo = ['.'] if tops is None else list(force)
+        seen = set()
+        unlisted = []  # dirs not listed, their sources still need a stat
+        while todo:
+            reldir = todo.pop()
+            path = os.path.join(self.src_dir, reldir)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # removed (since its parent was listed)
+            seen.add(reldir)
+            entry = self.dirs.get(reldir, None)
+            if full or entry is None or entry[0] != st.st_mtime_ns or \
+                    reldir in force:
+                entry = self._list_src_dir(reldir, path, st)
+            else:
+                unlisted.append(reldir)
+            todo.extend(os.path.normpath(os.path.join(reldir, subdir))
+                        for subdir in entry[1])
+
+        # directories gone, and the sources they had
+        def below(reldir):
+            return tops is None or any(
+                top == '.' or reldir == top or reldir.startswith(top + '/')
+                for top in tops)
+
+        for reldir in [d for d in self.dirs if d not in seen and below(d)]:
+            for fname in self.dirs.pop(reldir)[2]:
+                self._pop_src(os.path.join(reldir, fname))
+            self.dirty.add(('dirs', reldir))
+            self.changed = True
+
+        # sources edited in place, in dirs that did not change
+        relpaths = [os.path.join(reldir, fname) for reldir in unlisted
+                    for fname in self.dirs[reldir][2]]
+        stats = self.stats.stat_many(os.path.join(self.src_dir, relpath)
+                                     for relpath in relpaths)
+        for relpath in relpaths:
+            st = stats[os.path.join(self.src_dir, relpath)]
+            old = self.srcs.get(relpath, None)
+            if st is not None and old is not None:
+                self._set_src(relpath, [st.st_mtime_ns, old[1]])
         return self
 
-    def _add_dsts(self):
-        'add/update idx entries based on destinations'
-        for frel in rgx_files(self.dst_dir, self.dst_mtr):
-            if frel.count('/') != 1:
-                log.error('weirdly placed mtr.idx', frel)
-                continue
+    def _list_src_dir(self, reldir, path, st):
+        'list a src dir & stat its sources, returns its new dirs entry'
+        subdirs, fnames = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # like os.walk, do not descend into symlinked dirs
+                if entry.is_dir(follow_symlinks=False):
+                    subdir = os.path.normpath(os.path.join(reldir,
+                                                           entry.name))
+                    if not self.matcher.prune(subdir):
+                        subdirs.append(entry.name)
+                    continue
+                # no normpath just yet to allow globs like '[!.]**/*.md'
+                relpath = os.path.join(reldir, entry.name)
+                if not self.matcher.match(relpath):
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                except OSError:
+                    continue  # dangling symlink
+                fnames.append(entry.name)
+                old = self.srcs.get(relpath, None)
+                test_id = old[1] if old else hash_test_id(
+                    os.path.dirname(relpath), entry.name)
+                self._set_src(relpath, [mtime, test_id])
+
+        old = self.dirs.get(reldir, [0, [], []])
+        for fname in set(old[2]) - set(fnames):
+            self._pop_src(os.path.join(reldir, fname))
+        entry = [self._mtime(st), subdirs, fnames]
+        if entry != old:
+            self.dirty.add(('dirs', reldir))
+            self.changed = True
+        self.dirs[reldir] = entry
+        return entry
+
+    def _sync_dsts(self, full=False, names=None):
+        'update dsts, re-reading only outputs whose generation changed'
+        # names: dsts to check, without looking at dst_dir itself
+        if names is None:
+            # a compile replaces the <test_id> symlink, changing dst_dir
+            try:
+                st = os.stat(self.dst_dir)
+            except OSError:
+                return self
+            if full or st.st_mtime_ns != self.dst_mtime:
+                names = os.listdir(self.dst_dir)
+                gone = set(self.dsts) - set(names)
+            else:
+                # plain (pre generations) output dirs may change in place
+                names = [k for k, v in self.dsts.items() if v[0] is None]
+                gone = set()
+            dst_mtime = self._mtime(st)
+            if dst_mtime != self.dst_mtime:
+                self.dst_mtime = dst_mtime
+                self.changed = True
+        else:
+            gone = set()
 
-            test_id = os.path.dirname(frel)
-            if test_id not in self.idx:
-                # flag: O(rphaned) but playable (hopefully)
-                log.debug('Orphan found %r (source is missing)', test_id)
-                fname = os.path.join(self.dst_dir, test_id, 'mtr.idx')
-                idx = self._read_mtr_idx(fname)
-                if idx is not None:
-                    self.idx[test_id] = idx._replace(flag='O')
+        for name in names:
+            if name.startswith('.'):
                 continue
+            old = self.dsts.get(name, None)
+            new = self._read_dst(name, old, full)
+            if new is None:
+                gone.add(name)
+            elif new != old:
+                self.dsts[name] = new
+                self.touched.add(name)
+                self.dirty.add(('dsts', name))
+                self.changed = True
+
+        for name in gone:
+            if self.dsts.pop(name, None) is not None:
+                self.touched.add(name)
+                self.dirty.add(('dsts', name))
+                self.changed = True
+        return self
 
-            # set flag to U(pdateable) if at least 1 src.img is newer
-            fname = os.path.join(self.dst_dir, test_id, 'img.idx')
-            imgs = self._read_img_idx(fname)
-            for src, dst in imgs:
-                stime = os.path.getmtime(src) if os.path.isfile(src) else 0
-                dtime = os.path.getmtime(dst) if os.path.isfile(dst) else 0
-                if stime > dtime:
-                    f, src, cat, _ = self.idx[test_id]
-                    self.idx[test_id] = MtrIdx('U', src, cat, test_id)
-                    break
-
+    def _read_dst(self, name, old, full=False):
+        'return dsts entry for output name, None if it has none'
+        path = os.path.join(self.dst_dir, name)
+        try:
+            link = os.readlink(path)
+        except OSError:
+            link = None  # a plain directory, or not a dir at all
+        if not full and old is not None and link is not None and \
+                old[0] == link:
+            return old  # same generation, same output
+        fname = os.path.join(path, TEST_IDX)
+        try:
+            mtime = os.stat(fname).st_mtime_ns
+        except OSError:
+            return None  # no output (yet)
+        if not full and old is not None and old[:2] == [link, mtime]:
+            return old
+        idx = self._read_mtr_idx(fname)
+        imgs = self.stats.load(os.path.join(path, TEST_IMGS),
+                               self._read_img_idx, [])
+        imgs = sorted(set(os.path.normpath(src) for src, _ in imgs))
+        return [link, mtime, None if idx is None else list(idx),
+                self._imgs_newer(imgs, mtime), self._read_stats(path), imgs]
+
+    def _read_stats(self, path):
+        'return [numq, secs, finished] of path\'s last compile, or None'
+        try:
+            with open(os.path.join(path, TEST_STATS), 'rt') as fh:
+                stats = json.load(fh)
+            return [stats['questions'],
+                    stats['metrics'].get('compile', {}).get('secs', None),
+                    stats['finished']]
+        except (OSError, ValueError, KeyError, AttributeError):
+            return None  # compiled before stats were kept
+
+    def _entry(self, test_id):
+        'return idx entry for test_id based on srcs and dsts, or None'
+        frel = self.ids.get(test_id, None)
+        dst = self.dsts.get(test_id, None)
+        if frel is None:
+            if dst is None or dst[2] is None:
+                return None
+            # flag: O(rphaned) but playable (hopefully)
+            log.debug('Orphan found %r (source is missing)', test_id)
+            return MtrIdx(*dst[2])._replace(flag='O')
+
+        src_mtime = self.srcs[frel][0]
+        dst_mtime = 0 if dst is None else dst[1]
+        # flags: C(reate) dst, U(pdate) dst, P(lay) dst
+        flag = 'U' if src_mtime > dst_mtime else 'P'
+        flag = 'C' if dst_mtime == 0 else flag  # special case 'updatable'
+        if flag == 'P' and dst[3]:
+            flag = 'U'  # at least 1 src.img is newer
+        return MtrIdx(flag, os.path.join(self.src_dir, frel),
+                      os.path.dirname(frel), test_id)
+
+    def _build(self):
+        'rebuild idx entries of touched test_ids (or all of them)'
+        if self.rebuild:
+            self.idx = {}
+            touched = set(self.ids) | set(self.dsts)
+        else:
+            touched = self.touched
+        for test_id in touched:
+            entry = self._entry(test_id)
+            if entry is None:
+                self.idx.pop(test_id, None)
+            else:
+                self.idx[test_id] = entry
+        self.dirty.update(('tests', test_id) for test_id in touched)
+        self.touched = set()
+        self.rebuild = False
         return self
@@ -0,0 +1,383 @@
+# -*- encoding: utf8 -*-
+'''
+Keep one MantraIdx current in memory, by watching the filesystem.
+
+A background thread watches src_dir (all its subdirs) and dst_dir using
+inotify (linux) or, if that's not available, by polling with incremental
+syncs (and a full one every `full_every` polls).  Bursts of events are
+debounced and only the entries affected by them are updated.
+
+Page callbacks read a Snapshot: an immutable view of the index with a
+version number, which costs nothing to get and never touches the disk.
+
+Usage:
+
+watcher.start(cfg.src_dir, cfg.dst_dir)   # once, at startup
+snap = watcher.snapshot()                 # anywhere, anytime
+for idx in snap:                          # MtrIdx entries
+    ...
+snap.test_id(test_id)                     # -> MtrIdx or None
+snap.version                              # changes when the index does
+snap.page(2, 50, sort='category')         # 2nd page of 50 tests, & counts
+snap.tree.node('net').count               # tests in net & its subcategories
+watcher.refresh(dsts=[test_id])           # no need to wait for events
+watcher.db().query(sort='numq', limit=10) # numq, score, .. see idxdb.py
+'''
+
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+import time
+import logging
+
+# App imports
+from config import cfg
+import utils
+import idxdb
+from cattree import CategoryTree
+
+# -- Globals
+log = logging.getLogger(cfg.app_name)
+log.debug('logging via %s', log.name)
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# entries added, removed or renamed in a directory
+DIR_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+SRC_MASK = (DIR_EVENTS | IN_CLOSE_WRITE | IN_ATTRIB | IN_DELETE_SELF |
+            IN_MOVE_SELF | IN_ONLYDIR)
+DST_MASK = DIR_EVENTS | IN_ONLYDIR
+
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (of name)
+
+
+class Inotify(object):
+    'minimal inotify(7) using ctypes, raises OSError if not available'
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        try:
+            self._add = libc.inotify_add_watch
+            self._rm = libc.inotify_rm_watch
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except AttributeError:
+            raise OSError('inotify not available')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wds = {}  # wd -> path watched
+
+    def add(self, path, mask):
+        'watch path for events in mask, returns its watch descriptor'
+        wd = self._add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.wds[wd] = path
+        return wd
+
+    def remove(self, wd):
+        'stop watching wd'
+        if self.wds.pop(wd, None) is not None:
+            self._rm(self.fd, wd)
+
+    def read(self, timeout=None):
+        'return list of (path, mask, name) events, waits at most timeout'
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, size = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + size].rstrip(b'\0')
+            offset += size
+            path = self.wds.get(wd, None)
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)  # watched dir is gone
+            events.append((path, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _name(idx):
+    return idxdb.src_name(idx.src)
+
+
+class Snapshot(object):
+    'read-only view of the index at some version'
+    __slots__ = ('version', 'idx', 'tree', '_views')
+
+    # sort keys for view(), ties are broken by test_id
+    SORTS = {
+        'name': lambda idx: (_name(idx), idx.test_id),
+        'category': lambda idx: (idx.category, _name(idx), idx.test_id),
+        'flag': lambda idx: (idx.flag, _name(idx), idx.test_id),
+    }
+    MAX_VIEWS = 32  # nr of filtered views remembered per snapshot
+
+    def __init__(self, version, idx, tree=None):
+        self.version = version
+        self.idx = idx  # test_id -> MtrIdx, never modified
+        self.tree = CategoryTree.build(idx.values()) if tree is None \
+            else tree   # its categories, see cattree.py
+        self._views = {}
+
+    def __iter__(self):
+        return iter(self.idx.values())
+
+    def __len__(self):
+        return len(self.idx)
+
+    def test_id(self, test_id):
+        return self.idx.get(test_id, None)
+
+    def view(self, categories=(), flags='', search='', sort='name',
+             desc=False):
+        'return tuple of MtrIdx that match, sorted (computed once)'
+        # - categories, only tests in these categories & their subcategories
+        # - flags, only tests with one of these flags
+        # - search, only tests with this (case insensitive) in their name
+        if sort not in self.SORTS:
+            raise ValueError('cannot sort on {!r}'.format(sort))
+        categories = tuple(sorted(categories or ()))
+        search = (search or '').strip().lower()
+        key = (categories, flags or '', search, sort, bool(desc))
+        view = self._views.get(key, None)
+        if view is not None:
+            return view
+
+        if key[:3] == ((), '', ''):
+            # all tests, sorted: the base for other views with this sort
+            view = tuple(sorted(self.idx.values(), key=self.SORTS[sort],
+                                reverse=bool(desc)))
+        elif categories:
+            # just the tests in those subtrees, no need to scan all tests
+            view = tuple(sorted(
+                (idx for idx in map(self.idx.get,
+                                    self.tree.test_ids(categories))
+                 if (not flags or idx.flag in flags) and
+                 (not search or search in _name(idx))),
+                key=self.SORTS[sort], reverse=bool(desc)))
+        else:
+            view = tuple(
+                idx for idx in self.view(sort=sort, desc=desc)
+                if (not flags or idx.flag in flags) and
+                (not search or search in _name(idx)))
+        if len(self._views) >= self.MAX_VIEWS:
+            self._views.clear()
+        self._views[key] = view
+        return view
+
+    def page(self, page=1, size=50, **filters):
+        'return (rows, page, pages, total) for page of view(**filters)'
+        # page is clamped to the available pages, starting at 1
+        view = self.view(**filters)
+        total = len(view)
+        pages = max(1, -(-total // size))
+        page = min(max(1, page or 1), pages)
+        return view[(page - 1) * size:page * size], page, pages, total
+
+
+class Watcher(threading.Thread):
+    'keeps a MantraIdx current in memory, see module docstring'
+
+    def __init__(self, src_dir, dst_dir, debounce=0.2, max_delay=2.0,
+                 interval=5.0, use_inotify=True, full_every=12):
+        super().__init__(name='idx-watcher', daemon=True)
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.debounce = debounce    # quiet time that ends a burst of events
+        self.max_delay = max_delay  # never wait longer than this to update
+        self.interval = interval    # secs between syncs when polling
+        self.full_every = full_every  # polls between full syncs
+        self.use_inotify = use_inotify
+        self.inotify = None
+        self.updates = 0            # nr of index updates
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._src_wds = {}          # src reldir -> wd
+        self.idx = utils.MantraIdx(src_dir, dst_dir, sync=False)
+        self.idx.read().sync(full=True)
+        self._snapshot = Snapshot(0, dict(self.idx.idx))
+
+    def snapshot(self):
+        'return the current Snapshot of the index'
+        return self._snapshot
+
+    def sync(self, full=False):
+        'sync the index now, returns a Snapshot'
+        with self._lock:
+            self.idx.sync(full)
+            return self._publish()
+
+    def refresh(self, dirs=(), files=(), dsts=()):
+        'update the index for these src dirs, files & dsts, returns Snapshot'
+        with self._lock:
+            self.idx.refresh(dirs, files, dsts)
+            return self._publish()
+
+    def _publish(self):
+        'make a new snapshot if the index changed, called with lock held'
+        old, new = self._snapshot.idx, self.idx.idx
+        if new != old:
+            self.updates += 1
+            changed = [k for k in set(old) | set(new)
+                       if old.get(k, None) != new.get(k, None)]
+            tree = self._snapshot.tree.update(
+                [old[k] for k in changed if k in old],
+                [new[k] for k in changed if k in new])
+            self._snapshot = Snapshot(self._snapshot.version + 1, dict(new),
+                                      tree)
+            log.debug('index version %d, %d changed', self._snapshot.version,
+                      len(changed))
+        return self._snapshot
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        if self.use_inotify:
+            try:
+                self.inotify = Inotify()
+                self.inotify.add(self.dst_dir, DST_MASK)
+                self._watch_srcs()
+                self.sync()  # changes made before the watches were added
+            except OSError as e:
+                log.warning('inotify unavailable (%s), polling instead', e)
+                if self.inotify is not None:
+                    self.inotify.close()
+                self.inotify = None
+
+        polls = 0
+        while not self.stopped.is_set():
+            try:
+                if self.inotify is None:
+                    # a sync re-stats all sources, so edits show up, while
+                    # a full one also re-reads outputs changed in place
+                    self.stopped.wait(self.interval)
+                    polls += 1
+                    self.sync(full=polls % self.full_every == 0)
+                else:
+                    self._wait_events()
+            except Exception:
+                log.exception('index watcher')
+                self.stopped.wait(self.interval)
+
+    def _watch_srcs(self):
+        'watch src dirs not yet watched, returns those newly watched'
+        for reldir in set(self._src_wds) - set(self.idx.dirs):
+            self.inotify.remove(self._src_wds.pop(reldir))
+        added = []
+        for reldir in set(self.idx.dirs) - set(self._src_wds):
+            path = os.path.normpath(os.path.join(self.src_dir, reldir))
+            try:
+                self._src_wds[reldir] = self.inotify.add(path, SRC_MASK)
+                added.append(reldir)
+            except FileNotFoundError:
+                pass  # gone already, the next listing drops it
+        return added
+
+    def _wait_events(self):
+        'collect a burst of events and update the index accordingly'
+        events = self.inotify.read(timeout=1.0)
+        if not events:
+            return
+        start = time.time()
+        while time.time() - start < self.max_delay:
+            more = self.inotify.read(timeout=self.debounce)
+            if not more:
+                break
+            events.extend(more)
+
+        dirs, files, dsts, overflow = set(), set(), set(), False
+        for path, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                overflow = True  # events were lost
+            elif path is None:
+                continue  # watch was removed already
+            elif path == self.dst_dir:
+                if name and not name.startswith('.'):
+                    dsts.add(name)
+            else:
+                reldir = os.path.relpath(path, self.src_dir)
+                if mask & (DIR_EVENTS | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # its listing changed, or it is gone: list its parent
+                    dirs.add(reldir if not mask & (IN_DELETE_SELF |
+                                                   IN_MOVE_SELF)
+                             else os.path.dirname(reldir) or '.')
+                elif name:
+                    files.add(os.path.join(reldir, name))
+
+        with self._lock:
+            if overflow:
+                log.warning('index watcher missed events, full sync')
+                self.idx.sync(full=True)
+            else:
+                touched = self.idx.refresh(dirs, files, dsts)
+                log.debug('%d events, %d entries updated', len(events),
+                          len(touched))
+            added = self._watch_srcs()
+            if added:
+                # files created before their new dir was watched
+                self.idx.refresh(dirs=added)
+                self._watch_srcs()
+            self._publish()
+
+
+# the index watcher of this process, if started
+WATCHER = None
+
+
+def start(src_dir, dst_dir, **kwargs):
+    'start the (one) index watcher of this process, returns it'
+    global WATCHER
+    if WATCHER is None:
+        WATCHER = Watcher(src_dir, dst_dir, **kwargs)
+        WATCHER.start()
+    return WATCHER
+
+
+def snapshot():
+    'return a Snapshot of the index, only reads from disk without a watcher'
+    if WATCHER is not None:
+        return WATCHER.snapshot()
+    return Snapshot(0, utils.MantraIdx(cfg.src_dir, cfg.dst_dir).idx)
+
+
+def db():
+    'return the IdxDB (mantra.db) of the index, for columns snapshots lack'
+    if WATCHER is not None:
+        return WATCHER.idx.db
+    return utils.MantraIdx(cfg.src_dir, cfg.dst_dir).db
+
+
+def refresh(dirs=(), files=(), dsts=()):
+    'update the index now, eg. after publishing output, returns a Snapshot'
+    if WATCHER is not None:
+        return WATCHER.refresh(dirs, files, dsts)
+    return snapshot()